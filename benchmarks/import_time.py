@@ -0,0 +1,83 @@
+# время запуска: импорт модулей библиотеки и создание TradingPlatform/KeyClock в чистом интерпретаторе
+# python -m benchmarks.import_time --repeat 5 --compare
+# каждый замер - отдельный процесс python -X importtime, результаты дописываются в benchmarks/results.jsonl (scale = 0)
+import os
+import sys
+import json
+import argparse
+import datetime
+import subprocess
+from benchmarks.run import RESULTS_PATH, compare
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASES = {
+    'import connections': 'import connections',
+    'import instrumentation': 'import instrumentation',
+    'import users': 'import users',
+    'import devexapi': 'import devexapi',
+    'import reports': 'import reports',
+    # конструктор не должен открывать соединение и читать config.ini
+    'TradingPlatform()': 'import users; users.TradingPlatform()',
+    'KeyClock()': "import users; users.KeyClock('user')",
+}
+
+
+def _importtime(code: str) -> tuple:
+    """
+    :return: (время выполнения в секундах, суммарное время импортов, 5 самых дорогих пакетов верхнего уровня)
+    """
+    wrapped = f'import time; _start = time.perf_counter(); {code}; print(time.perf_counter() - _start)'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', wrapped], cwd=ROOT,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    # строки stderr: "import time: self [us] | cumulative | imported package", верхний уровень без отступа
+    top = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, package = line[len('import time:'):].split('|')
+        if not package.startswith('  '):
+            top[package.strip()] = int(cumulative) / 1e6
+    heaviest = sorted(top.items(), key=lambda item: item[1], reverse=True)[:5]
+    return float(result.stdout.strip().splitlines()[-1]), sum(top.values()), heaviest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--results', default=RESULTS_PATH)
+    parser.add_argument('--compare', action='store_true', help='сравнить с предыдущим прогоном')
+    parser.add_argument('--threshold', type=float, default=1.2, help='допустимое замедление для --compare')
+    args = parser.parse_args()
+
+    previous = []
+    if os.path.exists(args.results):
+        with open(args.results) as f:
+            previous = [json.loads(line) for line in f if line.strip()]
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    run_at = datetime.datetime.now().isoformat(timespec='seconds')
+
+    results = []
+    for name, code in CASES.items():
+        runs = [_importtime(code) for _ in range(args.repeat)]
+        seconds, imports, heaviest = min(runs, key=lambda run: run[0])
+        results.append({'run_at': run_at, 'commit': commit, 'scale': 0, 'name': f'startup {name}',
+                        'seconds': seconds, 'rows': 0, 'imports_seconds': imports})
+        print(f"{name:<25} {seconds:7.3f}s  "
+              + ', '.join(f'{package} {package_seconds:.3f}s' for package, package_seconds in heaviest))
+
+    with open(args.results, 'a') as f:
+        for r in results:
+            f.write(json.dumps(r) + '\n')
+
+    if args.compare:
+        regressions = compare(results, previous, args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['name']}: {r['baseline']:.3f}s -> {r['seconds']:.3f}s (x{r['ratio']:.2f})")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
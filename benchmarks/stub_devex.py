@@ -0,0 +1,90 @@
+# заглушка dxsca-web и dxweb register api для замеров DevexAccountInfo / DevexApiOperation без prod
+import re
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StubDevexHandler(BaseHTTPRequestHandler):
+    # задержка ответа в секундах, имитирует сеть и время обработки на стороне devexperts
+    latency = 0.02
+    token = 'stub-session-token'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: dict = None):
+        payload = json.dumps(body or {}).encode()
+        time.sleep(self.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _authorized(self) -> bool:
+        header = self.headers.get('Authorization', '')
+        return header == f'DXAPI {self.token}' or header.startswith('Basic ')
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_POST(self):
+        if self.path == '/dxsca-web/login':
+            self._read_body()
+            return self._reply(200, {'sessionToken': self.token, 'timeout': '00:30:00'})
+        self._reply(404)
+
+    def do_GET(self):
+        if not self._authorized():
+            return self._reply(401)
+        path = self.path.split('?')[0].replace('%3A', ':')
+        account = re.search(r'/accounts/LIVE:([^/]+)/', path)
+        if path.endswith('/metrics') and account:
+            return self._reply(200, {'metrics': [{'account': f'LIVE:{account.group(1)}', 'equity': 1000.0,
+                                                  'balance': 900.0, 'openPL': 100.0, 'totalPL': 150.0}]})
+        if path.endswith('/positions') and account:
+            return self._reply(200, {'positions': [{'positionCode': f'{account.group(1)}-{i}', 'symbol': 'EUR/USD',
+                                                    'quantity': 1000 * (i + 1)} for i in range(3)]})
+        if path.endswith('/orders') and account:
+            return self._reply(200, {'orders': [{'orderCode': f'LIVE:{account.group(1)}:{i}', 'symbol': 'EUR/USD',
+                                                 'status': 'WORKING'} for i in range(2)]})
+        client = re.search(r'/register/client/default/([^/]+)$', path)
+        if client:
+            return self._reply(200, {'accounts': [
+                {'accountCode': f'{client.group(1)}-{i}', 'clearingCode': 'LIVE' if i < 2 else 'DEMO',
+                 'categories': [{'category': 'Domain', 'value': 'default'},
+                                {'category': 'Group', 'value': f'group_{i}'}]} for i in range(3)]})
+        self._reply(404)
+
+    def do_PUT(self):
+        if not self._authorized():
+            return self._reply(401)
+        self._read_body()
+        self._reply(200)
+
+    def do_DELETE(self):
+        if not self._authorized():
+            return self._reply(401)
+        self._reply(200)
+
+
+class StubDevexServer():
+    """
+    локальный http-сервер в отдельном потоке: with StubDevexServer() as stub: stub.base_url
+    """
+    def __init__(self, latency: float = 0.02, port: int = 0):
+        handler = type('Handler', (StubDevexHandler,), {'latency': latency})
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
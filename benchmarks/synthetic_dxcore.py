@@ -0,0 +1,148 @@
+# синтетическая копия таблиц dxcore, которые читает TradingPlatform, для замеров без доступа к prod
+# нужна локальная PostgreSQL с базой dxcore: запросы обращаются к dxcore.dxcore.<таблица> и используют json, lateral и т.п.
+import time
+from sqlalchemy import create_engine, text
+
+
+SYMBOLS = [
+    # symbol, instrument_type, группа из additional_fields
+    ('EUR/USD', 'FX', 'Forex Majors'), ('GBP/USD', 'FX', 'Forex Majors'), ('USD/JPY', 'FX', 'Forex Majors'),
+    ('USD/CNH', 'FX', 'Forex Minors'), ('USD/MXN', 'FX', 'Forex Minors'), ('XAU/USD', 'FX', 'Forex Metals'),
+    ('BTC/USD', 'CRYPTO', 'Crypto'), ('ETH/USD', 'CRYPTO', 'Crypto'), ('SPX500', 'CFD', 'Indices'),
+    ('USDT$', 'CURRENCY', 'Currency'), ('BTC$', 'CURRENCY', 'Currency'), ('ETH$', 'CURRENCY', 'Currency'),
+]
+QUOTE_SYMBOLS = ['BTC/USD', 'ETH/USD', 'EUR/USD', 'GBP/USD', 'USD/JPY', 'USD/CNH', 'USD/MXN']
+
+DDL = """
+drop schema if exists dxcore cascade;
+create schema dxcore;
+create table dxcore.principals (id bigint primary key, name text, created_time timestamp);
+create table dxcore.instruments (id bigint primary key, symbol text, instrument_type text, additional_fields text);
+create table dxcore.accounts (id bigint primary key, account_code text, clearing_code text, owner_id bigint, currency_id bigint);
+create table dxcore.user_sessions (user_id bigint, expire_at timestamp);
+create table dxcore.orders (id bigint primary key, order_side text, created_time timestamp, transaction_time timestamp,
+    parameters text, extensions text, status text, filled_quantity numeric, order_chain_id bigint);
+create table dxcore.order_legs (order_id bigint, position_code text, price numeric, position_effect text);
+create table dxcore.activities (id bigint primary key, account_id bigint, order_id bigint, transaction_time timestamp,
+    created_time timestamp, activity_type text, linked_position_code text, description text, action_code text);
+create table dxcore.activity_legs (activity_id bigint, instrument_id bigint, position_code text, quantity numeric,
+    price numeric, leg_type text);
+create table dxcore.positions (account_id bigint, instrument_id bigint, code text, quantity numeric, cost numeric,
+    opening_time timestamp);
+create table dxcore.quotes_history (event_symbol text, bid_time timestamp, snapshot_time timestamp, bid_price numeric);
+"""
+
+INDEXES = """
+create index on dxcore.principals (created_time);
+create index on dxcore.user_sessions (expire_at);
+create index on dxcore.activities (transaction_time);
+create index on dxcore.activities (account_id);
+create index on dxcore.activity_legs (activity_id);
+create index on dxcore.order_legs (order_id);
+create index on dxcore.order_legs (position_code);
+create index on dxcore.orders ((order_chain_id::text));
+create index on dxcore.positions (code);
+create index on dxcore.quotes_history (event_symbol, bid_time);
+create index on dxcore.quotes_history (event_symbol, snapshot_time);
+"""
+
+
+def populate(engine, trades: int, date_from: str = '2023-03-01', seed: float = 0.42) -> dict:
+    """
+    пересоздает схему dxcore и наполняет ее данными, пропорциональными trades (числу сделок)
+    данные генерируются на стороне сервера через generate_series, поэтому 10M строк не идут через python
+    :return: размеры таблиц и время генерации
+    """
+    users = max(trades // 1000, 10)
+    accounts = users * 2
+    financial = max(trades // 10, 100)
+    positions = max(trades // 10, 100)
+    start = time.perf_counter()
+    instruments = ', '.join(
+        f"({i + 1}, '{symbol}', '{instrument_type}', '[{{\"val\": \"{group}\"}}]')"
+        for i, (symbol, instrument_type, group) in enumerate(SYMBOLS))
+    trade_instruments = f"array[{', '.join(str(i + 1) for i, s in enumerate(SYMBOLS) if s[1] != 'CURRENCY')}]"
+    currency_instruments = f"array[{', '.join(str(i + 1) for i, s in enumerate(SYMBOLS) if s[1] == 'CURRENCY')}]"
+    quote_symbols = ', '.join(f"'{symbol}'" for symbol in QUOTE_SYMBOLS)
+
+    statements = [
+        f"select setseed({seed})",
+        f"insert into dxcore.instruments values {instruments}",
+        f"""insert into dxcore.principals
+            select i, 'user_' || lpad(i::text, 6, '0'), timestamp '2023-02-01' + (i % 365) * interval '1 day'
+            from generate_series(1, {users}) i""",
+        f"""insert into dxcore.accounts
+            select i, 'ACC' || i, case when i % 10 = 0 then 'DEMO' else 'LIVE' end, (i - 1) % {users} + 1, 10
+            from generate_series(200, {accounts + 199}) i""",
+        f"""insert into dxcore.user_sessions
+            select (i - 1) % {users} + 1, timestamp '{date_from}' + random() * (now() - timestamp '{date_from}')
+            from generate_series(1, {users * 5}) i""",
+        f"""insert into dxcore.orders
+            select i, case when i % 2 = 0 then 'BUY' else 'SELL' end, t, t,
+                '{{"ORDER_EXEC_STRATEGY_NAME": "' || (array['B_BOOK', 'FX_STP', 'A_BOOK', 'MANUAL'])[1 + i % 4] || '"}}',
+                '[{{"val": {{"PL_SETTLED_IN_TRADE_CURRENCY": ' || round((random() * 200 - 100)::numeric, 2)
+                    || ', "hedgingOrderId": ' || case when i % 4 = 1 then {trades} + i else 0 end || '}}}}]',
+                'COMPLETED', round((random() * 10)::numeric, 4), i / 2
+            from (select i, timestamp '{date_from}' + random() * (now() - timestamp '{date_from}') as t
+                  from generate_series(1, {trades}) i) s""",
+        # хедж-ордера для FX_STP, на них ссылается hedgingOrderId
+        f"""insert into dxcore.orders
+            select {trades} + i, 'BUY', now(), now(), '{{}}', '[]', 'COMPLETED', 0, null
+            from generate_series(1, {trades}, 4) i""",
+        """insert into dxcore.order_legs
+            select id, ((id + 1) / 2)::text, round((random() * 100 + 1)::numeric, 5),
+                case when id % 2 = 0 then 'OPEN' else 'CLOSE' end
+            from dxcore.orders""",
+        f"""insert into dxcore.activities
+            select i, 200 + (i - 1) % {accounts}, i, o.transaction_time, o.created_time, 'TRADE', null, null, 'TRADE'
+            from generate_series(1, {trades}) i join dxcore.orders o on o.id = i""",
+        f"""insert into dxcore.activity_legs
+            select i, ({trade_instruments})[1 + i % array_length({trade_instruments}, 1)], ((i + 1) / 2)::text,
+                round((random() * 10 - 5)::numeric, 4), round((random() * 100 + 1)::numeric, 5), 'POS_ADJUST'
+            from generate_series(1, {trades}) i""",
+        f"""insert into dxcore.activities
+            select {trades} + i, 200 + (i - 1) % {accounts}, null, t, t,
+                (array['DEPOSIT', 'WITHDRAWAL', 'ADJUSTMENT', 'FINANCING'])[1 + i % 4],
+                null, case when i % 50 = 0 then 'test_transfer' else 'client transfer' end, 'FIN'
+            from (select i, timestamp '{date_from}' + random() * (now() - timestamp '{date_from}') as t
+                  from generate_series(1, {financial}) i) s""",
+        f"""insert into dxcore.activity_legs
+            select {trades} + i, ({currency_instruments})[1 + i % array_length({currency_instruments}, 1)], null,
+                round((random() * 1000 - 200)::numeric, 2), null, 'BALANCE'
+            from generate_series(1, {financial}) i""",
+        f"""insert into dxcore.positions
+            select 200 + (i - 1) % {accounts}, ({trade_instruments})[1 + i % array_length({trade_instruments}, 1)],
+                (i * 2)::text, round((random() * 10 - 5)::numeric, 4), round((random() * 1000)::numeric, 2), now()
+            from generate_series(1, {positions}) i""",
+        # балансы в валютах (positions.code is null) для balance()
+        f"""insert into dxcore.positions
+            select 200 + (i - 1) % {accounts}, ({currency_instruments})[1 + i % array_length({currency_instruments}, 1)],
+                null, round((random() * 1000)::numeric, 2), 0, now()
+            from generate_series(1, {accounts * 3}) i""",
+        # котировки каждый час по каждому символу за весь период
+        f"""insert into dxcore.quotes_history
+            select symbol, t, t,
+                case symbol when 'BTC/USD' then 30000 when 'ETH/USD' then 2000 when 'USD/JPY' then 140
+                    when 'USD/CNH' then 7 when 'USD/MXN' then 17 else 1.1 end * (0.9 + random() * 0.2)
+            from unnest(array[{quote_symbols}]) symbol,
+                generate_series(timestamp '{date_from}', now(), interval '1 hour') t""",
+    ]
+    with engine.begin() as conn:
+        for statement in DDL.split(';') + statements + INDEXES.split(';'):
+            if statement.strip():
+                conn.execute(text(statement))
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text('vacuum analyze'))
+
+    return {'trades': trades, 'users': users, 'accounts': accounts, 'financial': financial,
+            'positions': positions, 'seconds': time.perf_counter() - start}
+
+
+def user_names(engine, limit: int = 10) -> list:
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(text(f'select name from dxcore.principals order by id limit {limit}'))]
+
+
+if __name__ == '__main__':
+    import sys
+    print(populate(create_engine(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 10_000))
@@ -1,67 +1,215 @@
 # подключение к postgress
-from sqlalchemy import create_engine
+# sqlalchemy и requests импортируются внутри функций: импорт модуля не тянет клиентов, которые не понадобятся
+import os
 import configparser
-import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from instrumentation import instrumentation
 
 
+# путь к config.ini можно задать переменной окружения или присвоить connections.CONFIG_PATH до первого запроса
+CONFIG_PATH = os.environ.get('DEALING_LIBRARY_CONFIG', '/Users/p.matchenkov/Desktop/configurations/config.ini')
+
+
+def read_config(path: str = None) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read(path or CONFIG_PATH)
+    return config
+
 
 class Connection:
+    """
+    engine создаются один раз на процесс для каждой цели и набора параметров пула и переиспользуются,
+    create_engine ленивый - соединение открывается из пула при первом запросе
+    """
+    _engines = dict()
+    _lock = threading.Lock()
 
-    def connect_dxcore(self):
-        config = configparser.ConfigParser()
-        config.read('/Users/p.matchenkov/Desktop/configurations/config.ini')
-        password, localhost, bd_type, bd_name, login = (config['DXCORE_prod']['password'], config['DXCORE_prod']['localhost'],
-                                                        config['DXCORE_prod']['bd_type'], config['DXCORE_prod']['bd_name'],
-                                                        config['DXCORE_prod']['login'])
+    def __init__(self, pool_size: int = 5, max_overflow: int = 10, pool_pre_ping: bool = True,
+                 pool_recycle: int = 1800, prepare_threshold: int = 2):
+        """
+        :param prepare_threshold: для драйвера psycopg 3 (postgresql+psycopg://) - после скольких выполнений
+            на соединении запрос готовится на сервере (PREPARE) и дальше выполняется без повторного планирования
+        """
+        self.pool_options = {'pool_size': pool_size, 'max_overflow': max_overflow,
+                             'pool_pre_ping': pool_pre_ping, 'pool_recycle': pool_recycle}
+        self.prepare_threshold = prepare_threshold
 
-        engine = create_engine(f'{bd_type}://{login}:{password}@{localhost}/{bd_name}')
-        try:
-            engine.connect()
-            #print('connections to dxcore success')
-        except Exception as err:
-            print(err)
+    def _engine(self, target: str, url, **pool_options):
+        """
+        :param url: функция без аргументов, собирающая url из config.ini - вызывается только для нового engine
+        """
+        from sqlalchemy import create_engine
 
-        return engine
+        options = {**self.pool_options, **pool_options}
+        key = (target, self.prepare_threshold, tuple(sorted(options.items())))
+        with self._lock:
+            if key not in self._engines:
+                engine_url = url()
+                if engine_url.startswith('postgresql+psycopg:'):
+                    # psycopg2 подставляет параметры на клиенте, psycopg 3 передает их отдельно и кэширует
+                    # подготовленные запросы на соединении пула
+                    options['connect_args'] = {'prepare_threshold': self.prepare_threshold}
+                self._engines[key] = create_engine(engine_url, **options)
+            return self._engines[key]
 
-    def connect_cex_clickhouse(self):
-        config = configparser.ConfigParser()
-        config.read('/Users/p.matchenkov/Desktop/configurations/config.ini')
-        password, localhost, bd_type, bd_name, login = (config['PASSWORDS']['password'], config['LOCALHOST']['localhost'],
-                                                        config['NAMES']['bd_type'], config['NAMES']['bd_name'],
-                                                        config['PASSWORDS']['login'])
-        engine = create_engine(f'{bd_type}://{login}:{password}@{localhost}/{bd_name}')
-        try:
-            engine.connect()
-            print('connections to cex clickhouse success')
-        except Exception as err:
-            print(err)
-
-    def connect_to_fin_control(self):
-        config = configparser.ConfigParser()
-        config.read('/Users/p.matchenkov/Desktop/configurations/config.ini')
-        password = config['FINANCE_CONTROL']['password']
-        login = config['FINANCE_CONTROL']['login']
-        localhost = config['FINANCE_CONTROL']['localhost']
-        engine = create_engine(f'postgresql://{login}:{password}@{localhost}:5432/finance_control')
-        try:
-            engine.connect()
-            print('connections to fin_control success')
-        except Exception as err:
-            print(err)
-        return engine
-
-    def connect_to_accountmng(self):
-        config = configparser.ConfigParser()
-        config.read('/Users/p.matchenkov/Desktop/configurations/config.ini')
-        password = config['ACCOUNTMNG']['password']
-        login = config['ACCOUNTMNG']['login']
-        localhost = config['ACCOUNTMNG']['localhost']
-        engine = create_engine(f'postgresql://{login}:{password}@{localhost}:5432/accountmng')
+    @classmethod
+    def dispose_all(cls):
+        # закрывает все пулы, например перед fork или в конце скрипта
+        with cls._lock:
+            for engine in cls._engines.values():
+                engine.dispose()
+            cls._engines.clear()
+
+    @classmethod
+    def detach_after_fork(cls):
+        """
+        в дочернем процессе после fork: пулы забывают унаследованные соединения родителя, не закрывая их,
+        родитель продолжает работать со своими пулами. блокировка не берется - ее мог держать поток родителя
+        """
+        for engine in list(cls._engines.values()):
+            engine.dispose(close=False)
+
+    @staticmethod
+    def _config():
+        return read_config()
+
+    def connect_dxcore(self, **pool_options):
+        def url():
+            config = self._config()
+            password, localhost, bd_type, bd_name, login = (config['DXCORE_prod']['password'], config['DXCORE_prod']['localhost'],
+                                                            config['DXCORE_prod']['bd_type'], config['DXCORE_prod']['bd_name'],
+                                                            config['DXCORE_prod']['login'])
+            return f'{bd_type}://{login}:{password}@{localhost}/{bd_name}'
+        return self._engine('dxcore', url, **pool_options)
+
+    def connect_cex_clickhouse(self, **pool_options):
+        def url():
+            config = self._config()
+            password, localhost, bd_type, bd_name, login = (config['PASSWORDS']['password'], config['LOCALHOST']['localhost'],
+                                                            config['NAMES']['bd_type'], config['NAMES']['bd_name'],
+                                                            config['PASSWORDS']['login'])
+            return f'{bd_type}://{login}:{password}@{localhost}/{bd_name}'
+        return self._engine('clickhouse', url, **pool_options)
+
+    def connect_to_fin_control(self, **pool_options):
+        def url():
+            config = self._config()
+            password = config['FINANCE_CONTROL']['password']
+            login = config['FINANCE_CONTROL']['login']
+            localhost = config['FINANCE_CONTROL']['localhost']
+            return f'postgresql://{login}:{password}@{localhost}:5432/finance_control'
+        return self._engine('finance_control', url, **pool_options)
+
+    def connect_to_accountmng(self, **pool_options):
+        def url():
+            config = self._config()
+            password = config['ACCOUNTMNG']['password']
+            login = config['ACCOUNTMNG']['login']
+            localhost = config['ACCOUNTMNG']['localhost']
+            return f'postgresql://{login}:{password}@{localhost}:5432/accountmng'
+        return self._engine('accountmng', url, **pool_options)
+
+
+# подключение к http api: общая сессия с пулом соединений и повтором временных ошибок
+def http_session(pool_size: int = 16, retries: int = 3, backoff: float = 0.5):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset({'GET', 'PUT', 'DELETE'}), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(instrumentation.record_response)
+    return session
+
+
+class RateLimiter:
+    """
+    общий для потоков ограничитель: не больше rate вызовов wait() в секунду, rate=None - без ограничения
+    """
+    def __init__(self, rate: float = None):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def fan_out(fetch, keys: list, max_workers: int = 8, key_name: str = 'account_id'):
+    """
+    параллельно вызывает fetch(key) для каждого ключа с ограничением max_workers потоков
+    :return: (объединенный датафрейм результатов с колонкой key_name, датафрейм ошибок key_name/error)
+    """
+    def run(key):
+        # любая ошибка по ключу (сеть, пустой или null ответ) попадает в датафрейм ошибок, остальные ключи продолжают
         try:
-            engine.connect()
-            print('connections to accountmng success')
+            return fetch(key), None
         except Exception as err:
-            print(err)
+            logging.error(f"{key}: {err}")
+            return None, repr(err)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(run, keys))
+
+    frames = [df.assign(**{key_name: key}) for key, (df, _) in zip(keys, results) if df is not None and not df.empty]
+    errors = pd.DataFrame([{key_name: key, 'error': err} for key, (_, err) in zip(keys, results) if err is not None],
+                          columns=[key_name, 'error'])
+    return (pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()), errors
+
+
+class TokenProvider:
+    """
+    потокобезопасный кэш токена сессии: login() вызывается при первом запросе, незадолго до истечения ttl
+    или после invalidate (например, на ответ 401)
+    :param login: функция без аргументов, вернет (token, время жизни в секундах или None)
+    """
+    def __init__(self, login, ttl: int = 1200, refresh_margin: int = 60):
+        self._login = login
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._token = None
+        self._refresh_at = 0.0
+
+    def get(self) -> str:
+        with self._lock:
+            if self._token is None or time.monotonic() >= self._refresh_at:
+                token, expires_in = self._login()
+                lifetime = expires_in or self.ttl
+                # у коротких токенов (keycloak, ~60 сек) запас не больше четверти времени жизни
+                self._token = token
+                self._refresh_at = time.monotonic() + lifetime - min(self.refresh_margin, lifetime / 4)
+            return self._token
+
+    def invalidate(self, token: str = None):
+        # токен сбрасывается, только если его еще не обновил другой поток
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+
+
+_token_providers = dict()
+_token_providers_lock = threading.Lock()
 
-        return engine
 
+def token_provider(key: tuple, login, ttl: int = 1200) -> TokenProvider:
+    """
+    общий на процесс TokenProvider для key (например, (base_url, login)), создается при первом обращении
+    """
+    with _token_providers_lock:
+        if key not in _token_providers:
+            _token_providers[key] = TokenProvider(login, ttl)
+        return _token_providers[key]
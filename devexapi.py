@@ -1,176 +1,389 @@
-import configparser
+import os
 import requests
 from requests.auth import HTTPBasicAuth
 import json
 import warnings
 import pandas as pd
 import uuid
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from connections import http_session, fan_out, token_provider, RateLimiter, read_config
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
-class DevexApi():
-    logging.basicConfig(level=logging.INFO,
-                        format="%(asctime)s %(levelname)s %(message)s",
-                        handlers=[
-                            logging.FileHandler("/Users/p.matchenkov/Desktop/devex log/prod_log.log"),
-                            logging.StreamHandler()
-                        ])
+# лог операций с prod: путь задается переменной окружения или аргументом configure_logging
+LOG_PATH = os.environ.get('DEALING_LIBRARY_LOG', '/Users/p.matchenkov/Desktop/devex log/prod_log.log')
+_logging_configured = False
+
+
+def configure_logging(log_path: str = None, level: int = logging.INFO):
+    """
+    настраивает лог один раз на процесс при создании первого DevexApi, а не при импорте модуля.
+    файловый лог пишется, только если существует его каталог, иначе только в консоль
+    """
+    global _logging_configured
+    if _logging_configured:
+        return
+    log_path = log_path or LOG_PATH
+    handlers = [logging.StreamHandler()]
+    if os.path.isdir(os.path.dirname(log_path) or '.'):
+        handlers.append(logging.FileHandler(log_path))
+    logging.basicConfig(level=level, format="%(asctime)s %(levelname)s %(message)s", handlers=handlers)
+    _logging_configured = True
 
 
-    def __init__(self):
-        self.config = configparser.ConfigParser()
-        self.config.read('/Users/p.matchenkov/Desktop/configurations/config.ini')
+class DevexApi():
+    def __init__(self, config_path: str = None):
+        """
+        :param config_path: None - connections.CONFIG_PATH
+        """
+        configure_logging()
+        self.config = read_config(config_path)
         self.login = self.config['AURORA_prod']['login']
         self.password = self.config['AURORA_prod']['password']
         self.base_url = self.config['AURORA_API']['base_url']
+        # одна сессия на объект: keep-alive и пул соединений вместо нового TLS-рукопожатия на каждый запрос
+        self.session = http_session()
+        self.timeout = 30
+        # токен dxsca-web общий для всех объектов с тем же base_url и логином
+        self.tokens = token_provider(('dxsca-web', self.base_url, self.config['AURORA_API']['login']),
+                                     self._login_dx_api)
+
+    def _login_dx_api(self) -> tuple:
+        json_data = {"username": self.config['AURORA_API']['login'],
+                     "domain": "default",
+                     "password": self.config['AURORA_API']['password']}
+        response = self.session.post(f'{self.base_url}/dxsca-web/login', json=json_data, timeout=self.timeout)
+        response.raise_for_status()
+        return json.loads(response.text)['sessionToken'], None
+
+    def _request_dx(self, method: str, url: str, token: str = None) -> requests.Response:
+        """
+        запрос к dxsca-web, без token берется кэшированный токен сессии.
+        на 401 токен обновляется и запрос повторяется один раз
+        """
+        token = token or self.tokens.get()
+        response = self.session.request(method, url, headers={'Authorization': f"DXAPI {token}"}, timeout=self.timeout)
+        if response.status_code == 401:
+            self.tokens.invalidate(token)
+            response = self.session.request(method, url, headers={'Authorization': f"DXAPI {self.tokens.get()}"},
+                                            timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def _get_dx(self, url: str, token: str = None) -> requests.Response:
+        return self._request_dx('GET', url, token)
+
+    def _orders_frame(self, account_id: str, token: str = None) -> pd.DataFrame:
+        url = f"{self.base_url}/dxsca-web/accounts/LIVE%3A{account_id}/orders"
+        return pd.DataFrame(self._get_dx(url, token).json()['orders'])
 
 
 class DevexApiConnection(DevexApi):
     def _get_token_dx_api(self) -> str:
-        config = configparser.ConfigParser()
-        config.read('/Users/p.matchenkov/Desktop/configurations/config.ini')
-        username = config['AURORA_API']['login']
-        password = config['AURORA_API']['password']
-        json_data = {"username": username,
-                     "domain": "default",
-                     "password": password}
-        response = requests.post(f'{self.base_url}/dxsca-web/login', json=json_data)
-        token = json.loads(response.text)['sessionToken']
-        return token
+        # логин выполняется только если кэшированный токен отсутствует или скоро истечет
+        return self.tokens.get()
 
 
 class DevexAccountInfo(DevexApi):
     """
     получение датафрйма с основными параметрами всех аккаунтов юзера
     """
+    def _accounts_frame(self, user_up: str, clearingCode='LIVE') -> pd.DataFrame:
+        url = f'{self.base_url}/dxweb/rest/api/register/client/default/{user_up}'
+        response = self.session.get(url, auth=HTTPBasicAuth(self.login, self.password), timeout=self.timeout)
+        response.raise_for_status()
+        response = response.json()
+        if 'accounts' not in response.keys():
+            return pd.DataFrame()
+
+        accounts = pd.DataFrame(response['accounts'])
+        accounts = accounts.loc[accounts['clearingCode'] == clearingCode].reset_index(drop=True)
+        # категории всех аккаунтов разворачиваются в строки и сводятся одной pivot_table
+        categories = accounts['categories'].explode().dropna()
+        accounts_info = accounts.drop(columns={'categories'})
+        if not categories.empty:
+            categories = pd.DataFrame(categories.tolist(), index=categories.index)
+            accounts_info = accounts_info.join(categories.pivot_table(index=categories.index, columns='category',
+                                                                      values='value', aggfunc=lambda x: ' '.join(x)))
+        accounts_info['user_id'] = user_up
+        return accounts_info
+
     def get_user_accounts_info(self, user_up: str, clearingCode='LIVE') -> pd.DataFrame:
 
         try:
-            url = f'{self.base_url}/dxweb/rest/api/register/client/default/{user_up}'
-            response = requests.get(url, auth=HTTPBasicAuth(self.login, self.password))
-            response.raise_for_status()
-            logging.info(f"get_user_accounts {user_up}: successful with result: {response.status_code}.")
+            accounts_info = self._accounts_frame(user_up, clearingCode)
+            logging.info(f"get_user_accounts {user_up}: successful")
         except requests.exceptions.RequestException as err:
-            logging.error(f"get_user_accounts for {user_up}: requests.exceptions.RequestException: {response.status_code}", exc_info=True)
+            logging.error(f"get_user_accounts for {user_up}: requests.exceptions.RequestException", exc_info=True)
             raise SystemExit(err)
 
-        response = response.json()
-        if 'accounts' in response.keys():
-            response = pd.DataFrame(response['accounts'])
-            response = response.loc[response['clearingCode'] == clearingCode]
-
-            accounts_info = pd.DataFrame()
-            for row in range(len(response)):
-                accounts_info = pd.concat([accounts_info,
-                                           pd.DataFrame(response.iloc[row]['categories']).pivot_table(columns='category', values='value', aggfunc=lambda x: ' '.join(x))], axis=0)
-            accounts_info = pd.concat([response, accounts_info.reset_index()], axis=1).drop(columns={'categories'})
-            accounts_info['user_id'] = user_up
-            return accounts_info
-        else:
+        if accounts_info.empty:
             logging.error(f'{user_up} user has no accounts')
+        else:
+            return accounts_info
 
 
-    def get_metrics(self, account_id: str, token: str, include_positions: str = 'false') -> pd.DataFrame:
+    def get_user_accounts_info_many(self, users: list, clearingCode='LIVE', max_workers: int = 8) -> tuple:
+        """
+        аккаунты и их категории по списку юзеров параллельно
+        :return: (датафрейм аккаунтов всех юзеров, датафрейм ошибок user_id/error)
+        """
+        return fan_out(lambda user_up: self._accounts_frame(user_up, clearingCode), users, max_workers,
+                       key_name='user_id')
+
+
+    def _metrics_frame(self, account_id: str, token: str = None, include_positions: str = 'false') -> pd.DataFrame:
+        url = f"{self.base_url}/dxsca-web/accounts/LIVE:{account_id}/metrics?include-positions={include_positions}"
+        metrics = self._get_dx(url, token).json()['metrics'][0]
+        return pd.DataFrame({
+            'account': [metrics['account']],
+            'equity': [metrics['equity']],
+            'balance': [metrics['balance']],
+            'openPL': [metrics['openPL']],
+            'totalPL': [metrics['totalPL']]
+        })
+
+    def _positions_frame(self, account_id: str, token: str = None) -> pd.DataFrame:
+        url = f'{self.base_url}/dxsca-web/accounts/LIVE%3A{account_id}/positions'
+        return pd.DataFrame(self._get_dx(url, token).json()['positions'])
+
+    def get_metrics(self, account_id: str, token: str = None, include_positions: str = 'false') -> pd.DataFrame:
         """
         получение датафрмейма с метриками (фпл, пнл, баланс, еквити)
-        :param token: авторизация с помощью токена _get_token_dx_api
+        :param token: авторизация с помощью токена _get_token_dx_api, по умолчанию общий кэшированный токен
         :param include_positions: true вернет датафрейм с позициями
         :return:
         """
         try:
-            url = f"{self.base_url}/dxsca-web/accounts/LIVE:{account_id}/metrics?include-positions={include_positions}"
-            response = requests.get(url, headers={'Authorization': f"DXAPI {token}"})
-            response.raise_for_status()
-            logging.info(f"{response.status_code}, metrics for {account_id} successfully received")
+            df = self._metrics_frame(account_id, token, include_positions)
+            logging.info(f"metrics for {account_id} successfully received")
         except requests.exceptions.RequestException as err:
-            logging.error(f"{response.status_code}, data for {account_id} doesnt received, {err}")
+            logging.error(f"data for {account_id} doesnt received, {err}")
             raise SystemExit(err)
-
-        response = response.json()
-        df = pd.DataFrame({
-            'account': [response['metrics'][0]['account']],
-            'equity': [response['metrics'][0]['equity']],
-            'balance': [response['metrics'][0]['balance']],
-            'openPL': [response['metrics'][0]['openPL']],
-            'totalPL': [response['metrics'][0]['totalPL']]
-        })
         return df
 
 
-    def get_positions_id(self, account_id: str, token: str) -> pd.DataFrame:
+    def get_positions_id(self, account_id: str, token: str = None) -> pd.DataFrame:
         """
         вернет датафрйм со всеми позициями
         """
-
         try:
-            url = f'{self.base_url}/dxsca-web/accounts/LIVE%3A{account_id}/positions'
-            response = requests.get(url, headers={'Authorization': f"DXAPI {token}"})
-            response.raise_for_status()
-            logging.info(f"{response.status_code}, position for {account_id} received")
+            positions = self._positions_frame(account_id, token)
+            logging.info(f"position for {account_id} received")
         except requests.exceptions.RequestException as err:
-            logging.error(f"{response.status_code}, position for {account_id} doesnt received, {err}")
+            logging.error(f"position for {account_id} doesnt received, {err}")
             raise SystemExit(err)
 
-        positions = pd.DataFrame(response.json()['positions'])
         if positions.empty:
             logging.info(f"{account_id} has no positions")
         else:
             return positions
 
 
-    def get_accounts_orders(self, account_id: str, token: str) -> pd.DataFrame:
+    def get_accounts_orders(self, account_id: str, token: str = None) -> pd.DataFrame:
         """
         вернет датафрйм со отложенными ордерами
         """
         # orderCode нужно передать в отмену ордеров
         try:
-            url = f"{self.base_url}/dxsca-web/accounts/LIVE%3A{account_id}/orders"
-            response = requests.get(url, headers={'Authorization': f"DXAPI {token}"})
-            response.raise_for_status()
-            logging.info(f"{response.status_code}, orders for {account_id} successfully received")
+            orders = self._orders_frame(account_id, token)
+            logging.info(f"orders for {account_id} successfully received")
         except requests.exceptions.RequestException as err:
-            logging.error(f"{response.status_code}, data for {account_id} doesnt received, {err}")
+            logging.error(f"data for {account_id} doesnt received, {err}")
+            return None
 
-        orders = pd.DataFrame(response.json()['orders'])
         if orders.empty:
             logging.info(f"{account_id} has no orders")
         else:
             return orders
 
 
+    def get_metrics_many(self, account_ids: list, token: str = None, include_positions: str = 'false',
+                         max_workers: int = 8) -> tuple:
+        """
+        метрики по списку аккаунтов параллельно, ошибка по одному аккаунту не останавливает остальные
+        :return: (датафрейм метрик всех аккаунтов, датафрейм ошибок account_id/error)
+        """
+        return fan_out(lambda account_id: self._metrics_frame(account_id, token, include_positions),
+                       account_ids, max_workers)
+
+
+    def get_positions_many(self, account_ids: list, token: str = None, max_workers: int = 8) -> tuple:
+        """
+        позиции по списку аккаунтов параллельно
+        :return: (датафрейм позиций с колонкой account_id, датафрейм ошибок account_id/error)
+        """
+        return fan_out(lambda account_id: self._positions_frame(account_id, token), account_ids, max_workers)
+
+
+    def get_accounts_orders_many(self, account_ids: list, token: str = None, max_workers: int = 8) -> tuple:
+        """
+        отложенные ордера по списку аккаунтов параллельно
+        :return: (датафрейм ордеров с колонкой account_id, датафрейм ошибок account_id/error)
+        """
+        return fan_out(lambda account_id: self._orders_frame(account_id, token), account_ids, max_workers)
+
+
 class DevexApiOperation(DevexApi):
+    def _put_category(self, account: str, category: str, body: dict) -> requests.Response:
+        url = f'{self.base_url}/dxweb/rest/api/register/account/LIVE/{account}/category/{category}'
+        response = self.session.put(url, json=body, auth=HTTPBasicAuth(self.login, self.password), timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+
+    def _put_adjustment(self, account_id, amount, comment, currency: str, adjustment_id: str) -> requests.Response:
+        # adjustment_id - ключ идемпотентности: повтор с тем же ключом не создает вторую корректировку
+        url = f"{self.base_url}/dxweb/rest/api/register/account/LIVE/{account_id}/adjustment/{adjustment_id}"
+        body = {
+            "currency": currency,
+            "amount": amount,
+            "description": comment
+        }
+        response = self.session.put(url, auth=HTTPBasicAuth(self.login, self.password), json=body, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+
     def change_domain_group(self, account: str, category: str, body: dict):
         try:
-            url = f'{self.base_url}/dxweb/rest/api/register/account/LIVE/{account}/category/{category}'
-            response = requests.put(url, json=body, auth=HTTPBasicAuth(self.login, self.password))
-            response.raise_for_status()
+            response = self._put_category(account, category, body)
             logging.info(f"{response.status_code} - set category '{category}' for {account} successfully changed {body['value']}")
         except requests.exceptions.RequestException as err:
             logging.error(f"{err} - '{category}' group doesnt changed for {account}")
 
 
-    def make_adjustment(self, account_id, amount, comment, currency='USDT'):
+    def make_adjustment(self, account_id, amount, comment, currency='USDT', adjustment_id: str = None):
         try:
-            url = f"{self.base_url}/dxweb/rest/api/register/account/LIVE/{account_id}/adjustment/{str(uuid.uuid4())}"
-            body = {
-                "currency": currency,
-                "amount": amount,
-                "description": comment
-            }
-            response = requests.put(url, auth=HTTPBasicAuth(self.login, self.password), json=body)
-            response.raise_for_status()
+            response = self._put_adjustment(account_id, amount, comment, currency, adjustment_id or str(uuid.uuid4()))
             logging.info(f"{response.status_code}, adjustment for {account_id} completed, amount = {amount}")
         except requests.exceptions.RequestException as err:
-            logging.error(f"{response.status_code}, adjustment for {account_id} failed: {err}")
+            logging.error(f"adjustment for {account_id} failed: {err}")
+
+
+    def _execute_batch(self, batch: pd.DataFrame, send, max_workers: int, rate: float) -> pd.DataFrame:
+        """
+        выполняет send(row) для строк batch со статусом не 'done' параллельно и не чаще rate запросов в секунду
+        :return: batch с колонками status (done/failed), http_status, error, seconds, finished_at
+        """
+        batch = batch.reset_index(drop=True).copy()
+        for column in ('status', 'http_status', 'error', 'seconds', 'finished_at'):
+            if column not in batch.columns:
+                batch[column] = None
+        limiter = RateLimiter(rate)
+
+        def run(item):
+            i, row = item
+            limiter.wait()
+            start = time.perf_counter()
+            try:
+                response = send(row)
+                status, http_status, error = 'done', response.status_code, None
+            # любая ошибка строки (сеть, http, сериализация тела) - failed, остальные строки продолжают выполняться
+            except Exception as err:
+                status, http_status = 'failed', getattr(getattr(err, 'response', None), 'status_code', None)
+                error = f'{type(err).__name__}: {err}'
+            return i, status, http_status, error, time.perf_counter() - start, pd.Timestamp.now()
+
+        # строки копируются до запуска потоков, статусы пишутся в batch после завершения пула
+        todo = [(i, row) for i, row in batch.iterrows() if row['status'] != 'done']
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(run, todo))
+        for i, status, http_status, error, seconds, finished_at in results:
+            batch.at[i, 'status'], batch.at[i, 'http_status'] = status, http_status
+            batch.at[i, 'error'], batch.at[i, 'seconds'], batch.at[i, 'finished_at'] = error, seconds, finished_at
+        logging.info(f"batch finished: {(batch['status'] == 'done').sum()} done, "
+                     f"{(batch['status'] == 'failed').sum()} failed, {len(todo)} sent")
+        return batch
+
 
+    @staticmethod
+    def adjustment_ids(batch: pd.DataFrame, batch_id: str) -> pd.Series:
+        """
+        ключи идемпотентности строк: uuid5 от batch_id, аккаунта, суммы, комментария, валюты и номера
+        среди одинаковых строк. повторный запуск того же пакета дает те же ключи
+        """
+        fields = batch[['account_id', 'amount', 'comment', 'currency']].astype(str)
+        occurrence = fields.groupby(list(fields.columns), sort=False).cumcount().astype(str)
+        names = fields.apply('|'.join, axis=1) + '|' + occurrence
+        return names.map(lambda name: str(uuid.uuid5(uuid.NAMESPACE_URL, f'dealing_library/{batch_id}/{name}')))
+
+
+    def make_adjustments(self, batch: pd.DataFrame, batch_id: str, max_workers: int = 8,
+                         rate: float = 10) -> pd.DataFrame:
+        """
+        пакетные корректировки баланса
+        :param batch: колонки account_id, amount, comment, необязательные currency (по умолчанию USDT) и adjustment_id.
+            для продолжения прерванного пакета передается возвращенный ранее статус-датафрейм:
+            строки со status == 'done' пропускаются, остальные повторяются с теми же adjustment_id
+        :param batch_id: имя пакета, например 'bonus-2024-05'. ключи строк выводятся из него (adjustment_ids),
+            поэтому перезапуск после падения или Ctrl-C не создает корректировки повторно.
+            намеренно повторяемый пакет запускается с новым batch_id
+        :param rate: не больше rate запросов в секунду
+        :return: batch с adjustment_id и колонками status, http_status, error, seconds, finished_at
+        """
+        batch = batch.reset_index(drop=True).copy()
+        if 'currency' not in batch.columns:
+            batch['currency'] = 'USDT'
+        if 'adjustment_id' not in batch.columns:
+            batch['adjustment_id'] = None
+        # ключи назначаются до отправки и не зависят от того, дошел ли прошлый запуск до возврата статусов
+        missing = batch['adjustment_id'].isna()
+        batch.loc[missing, 'adjustment_id'] = self.adjustment_ids(batch, batch_id)[missing]
+        return self._execute_batch(
+            batch,
+            lambda row: self._put_adjustment(row['account_id'], row['amount'], row['comment'], row['currency'],
+                                             row['adjustment_id']),
+            max_workers, rate)
+
+
+    def change_categories(self, batch: pd.DataFrame, max_workers: int = 8, rate: float = 10) -> pd.DataFrame:
+        """
+        пакетная смена категорий аккаунтов
+        :param batch: колонки account, category, body ({'value': ...}), для продолжения - прежний статус-датафрейм
+        :return: batch с колонками status, http_status, error, seconds, finished_at
+        """
+        return self._execute_batch(batch, lambda row: self._put_category(row['account'], row['category'], row['body']),
+                                   max_workers, rate)
 
-    def delete_open_order(self, order_id: str, account_id: str, token: str):
+
+    def _delete_order(self, order_id: str, account_id: str, token: str = None) -> requests.Response:
         order_id = order_id.replace(':', '%3A')
+        url = f'{self.base_url}/dxsca-web/accounts/LIVE%3A{account_id}/orders/{order_id}'
+        return self._request_dx('DELETE', url, token)
+
+
+    def delete_open_order(self, order_id: str, account_id: str, token: str = None):
         try:
-            url = f'{self.base_url}/dxsca-web/accounts/LIVE%3A{account_id}/orders/{order_id}'
-            response = requests.delete(url, headers={'Authorization': f"DXAPI {token}"})
-            response.raise_for_status()
+            response = self._delete_order(order_id, account_id, token)
             logging.info(f"{response.status_code}, order {order_id} for {account_id} delete")
         except requests.exceptions.RequestException as err:
-            logging.error(f"{response.status_code}, order {order_id} for {account_id} doesn't delete, {err}")
\ No newline at end of file
+            logging.error(f"order {order_id} for {account_id} doesn't delete, {err}")
+
+
+    def cancel_all_orders(self, account_ids: list, token: str = None, max_workers: int = 16,
+                          rate: float = None) -> pd.DataFrame:
+        """
+        отмена всех отложенных ордеров по списку аккаунтов: книги ордеров запрашиваются параллельно,
+        затем все отмены отправляются параллельно в пуле из max_workers потоков
+        :param rate: ограничение отмен в секунду, по умолчанию без ограничения
+        :return: по строке на ордер (stage='cancel') и на аккаунт, книгу которого не удалось получить (stage='fetch'),
+            с колонками status, http_status, error, seconds
+        """
+        start = time.perf_counter()
+        orders, errors = fan_out(lambda account_id: self._orders_frame(account_id, token), account_ids, max_workers)
+        fetch_seconds = time.perf_counter() - start
+
+        cancels = (orders[['account_id', 'orderCode']] if not orders.empty
+                   else pd.DataFrame(columns=['account_id', 'orderCode']))
+        cancels = self._execute_batch(
+            cancels, lambda row: self._delete_order(row['orderCode'], row['account_id'], token), max_workers, rate)
+        cancels['stage'] = 'cancel'
+        fetch_errors = errors.assign(stage='fetch', status='failed', orderCode=None)
+
+        logging.info(f"cancel_all_orders: {len(account_ids)} accounts, orders fetched in {fetch_seconds:.2f}s, "
+                     f"{(cancels['status'] == 'done').sum()} of {len(cancels)} orders cancelled "
+                     f"in {time.perf_counter() - start:.2f}s total")
+        return pd.concat([cancels, fetch_errors], ignore_index=True)
\ No newline at end of file
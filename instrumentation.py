@@ -0,0 +1,108 @@
+# замеры sql-запросов, http-вызовов и обработки в pandas для users.py и devexapi.py
+import time
+import logging
+import datetime
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+import pandas as pd
+
+
+@lru_cache(maxsize=256)
+def statement(req: str):
+    """
+    text() для запроса с параметрами, один объект на текст: разбор параметров и компиляция sqlalchemy
+    выполняются один раз на engine, а не при каждом вызове
+    """
+    from sqlalchemy import text
+
+    return text(req)
+
+
+class Instrumentation():
+    """
+    журнал замеров: kind (sql, http, pandas), name (метод или url), seconds, rows, bytes
+    bytes для sql - размер полученного датафрейма в памяти (оценка объема передачи), для http - размер тела ответа
+    :param slow_threshold: запросы дольше этого числа секунд пишутся в лог как медленные
+    :param explain: для медленных select-запросов сохранять EXPLAIN (ANALYZE, BUFFERS) - запрос выполняется повторно
+    """
+    def __init__(self, slow_threshold: float = 5.0, explain: bool = False, max_records: int = 10000):
+        self.slow_threshold = slow_threshold
+        self.explain = explain
+        self.enabled = True
+        self._records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    def record(self, kind: str, name: str, seconds: float, rows: int = None, size: int = None,
+               statement: str = None, plan: str = None):
+        if not self.enabled:
+            return
+        slow = seconds >= self.slow_threshold
+        if slow:
+            logging.warning(f"slow {kind} {name}: {seconds:.2f}s, rows={rows}, bytes={size}")
+        with self._lock:
+            self._records.append({'time': datetime.datetime.now(), 'kind': kind, 'name': name, 'seconds': seconds,
+                                  'rows': rows, 'bytes': size, 'slow': slow, 'statement': statement, 'plan': plan})
+
+    @contextmanager
+    def timed(self, kind: str, name: str):
+        """
+        замер блока кода, в выданный словарь можно записать rows и bytes
+        """
+        probe = {'rows': None, 'bytes': None}
+        start = time.perf_counter()
+        try:
+            yield probe
+        finally:
+            self.record(kind, name, time.perf_counter() - start, probe['rows'], probe['bytes'])
+
+    def read_sql(self, engine, req: str, name: str, columns: list = None, params: dict = None) -> pd.DataFrame:
+        """
+        выполняет запрос в датафрейм с замером времени, числа строк и объема, при explain - план медленного запроса
+        :param params: значения параметров :name из текста запроса
+        """
+        start = time.perf_counter()
+        with engine.connect() as conn:
+            df = pd.DataFrame(conn.execute(statement(req), params or {}), columns=columns)
+        seconds = time.perf_counter() - start
+
+        plan = None
+        if self.enabled and self.explain and seconds >= self.slow_threshold and req.lstrip().lower().startswith(('select', 'with')):
+            with engine.connect() as conn:
+                plan = '\n'.join(row[0] for row in conn.execute(statement(f'EXPLAIN (ANALYZE, BUFFERS) {req}'),
+                                                                 params or {}))
+        self.record('sql', name, seconds, len(df), int(df.memory_usage(deep=True).sum()), statement=req, plan=plan)
+        return df
+
+    def record_response(self, response, *args, **kwargs):
+        # response-хук requests: session.hooks['response'].append(instrumentation.record_response)
+        self.record('http', f"{response.request.method} {response.url.split('?')[0]}",
+                    response.elapsed.total_seconds(), size=len(response.content))
+        return response
+
+    def summary(self) -> pd.DataFrame:
+        """
+        все замеры одним датафреймом
+        """
+        with self._lock:
+            records = list(self._records)
+        return pd.DataFrame(records, columns=['time', 'kind', 'name', 'seconds', 'rows', 'bytes', 'slow',
+                                              'statement', 'plan'])
+
+    def summary_by_name(self) -> pd.DataFrame:
+        """
+        сводка по kind и name: число вызовов, суммарное и максимальное время, строки и байты
+        """
+        return (self.summary().groupby(['kind', 'name'])
+                .agg(calls=('seconds', 'count'), seconds=('seconds', 'sum'), max_seconds=('seconds', 'max'),
+                     rows=('rows', 'sum'), bytes=('bytes', 'sum'), slow=('slow', 'sum'))
+                .sort_values('seconds', ascending=False).reset_index())
+
+    def reset(self):
+        with self._lock:
+            self._records.clear()
+
+
+# общий журнал процесса, порог и explain настраиваются атрибутами: instrumentation.slow_threshold = 1
+instrumentation = Instrumentation()
@@ -0,0 +1,103 @@
+# расчет объема, pnl и markup ордеров в USD в пуле процессов: выгрузка делится на шарды по юзерам или месяцам,
+# каждый процесс считает недельные суммы своего шарда, в основной процесс возвращаются только суммы
+import os
+import logging
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from connections import Connection
+from schema import apply_schema, ORDERS_SCHEMA
+from users import TradingPlatform
+
+
+FX_DTYPE = np.dtype([('day', 'i8'), ('currency', 'i4'), ('bid_price', 'f8')])
+# курсы в процессе-воркере, заполняются в _attach_fx_rates
+_fx_rates = None
+
+
+class SharedFxRates:
+    """
+    таблица курсов (transaction_time, quote_currency, bid_price) в shared memory: воркеры читают один блок
+    памяти вместо копии датафрейма в каждой задаче. валюты передаются списком, в блоке - их номера
+    """
+    def __init__(self, market_data: pd.DataFrame):
+        currencies = market_data['quote_currency'].astype('category')
+        self.currencies = list(currencies.cat.categories)
+        self.size = len(market_data)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(self.size, 1) * FX_DTYPE.itemsize)
+        rates = np.ndarray(self.size, dtype=FX_DTYPE, buffer=self.shm.buf)
+        rates['day'] = pd.to_datetime(market_data['transaction_time']).to_numpy('datetime64[D]').astype('i8')
+        rates['currency'] = currencies.cat.codes.to_numpy()
+        rates['bid_price'] = market_data['bid_price'].to_numpy(dtype='f8')
+
+    def initargs(self) -> tuple:
+        return self.shm.name, self.size, self.currencies
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _attach_fx_rates(name: str, size: int, currencies: list):
+    # initializer воркера: курсы собираются в датафрейм один раз на процесс
+    global _fx_rates
+    Connection.detach_after_fork()
+    # блок создан и удаляется основным процессом, воркеры пула используют его resource tracker
+    shm = shared_memory.SharedMemory(name=name)
+    rates = np.ndarray(size, dtype=FX_DTYPE, buffer=shm.buf)
+    _fx_rates = pd.DataFrame({
+        'transaction_time': pd.to_datetime(rates['day'].astype('datetime64[D]')).date,
+        'quote_currency': pd.Categorical.from_codes(rates['currency'], currencies).astype(object),
+        'bid_price': rates['bid_price'].copy(),
+    })
+    shm.close()
+
+
+def _rollup_shard(orders: pd.DataFrame, freq: str, by: list) -> pd.DataFrame:
+    orders = TradingPlatform._prepare_orders(orders, _fx_rates)
+    keys = [pd.Grouper(key='transaction_time', freq=freq, closed='left')] + by
+    return orders.groupby(keys, observed=True).agg(volume=('volume', 'sum'), pnl=('pnl', 'sum'),
+                                                   markup=('markup', 'sum'), trades=('order_id', 'count'))
+
+
+def shards(orders: pd.DataFrame, shard_by: str = 'user_id', count: int = None) -> list:
+    """
+    делит сырую выгрузку _orders_request на части. одинаковые строки всегда попадают в один шард,
+    поэтому drop_duplicates внутри шарда дает тот же результат, что и по всей выгрузке
+    :param shard_by: 'user_id' - юзеры раскладываются по count шардам, 'month' - шард на каждый месяц
+    """
+    if shard_by == 'month':
+        key = pd.to_datetime(orders['transaction_time']).dt.strftime('%Y-%m')
+    elif shard_by == 'user_id':
+        key = orders['user_id'].astype('category').cat.codes % (count or os.cpu_count() or 1)
+    else:
+        raise ValueError(f"shard_by should be 'user_id' or 'month', got {shard_by}")
+    return [part for _, part in orders.groupby(key, sort=False)]
+
+
+def rollup(orders: pd.DataFrame, market_data: pd.DataFrame, freq: str, by: list = None,
+           shard_by: str = 'user_id', processes: int = None) -> pd.DataFrame:
+    """
+    недельные (freq) суммы volume, pnl, markup и число сделок по сырой выгрузке ордеров, посчитанные в processes процессах
+    """
+    processes = processes or os.cpu_count() or 1
+    by = list(by or [])
+    # на каждый процесс несколько шардов юзеров, чтобы крупные юзеры не задерживали весь расчет
+    parts = shards(orders, shard_by, processes * 4)
+    with SharedFxRates(market_data) as fx_rates, \
+            ProcessPoolExecutor(max_workers=processes, initializer=_attach_fx_rates,
+                                initargs=fx_rates.initargs()) as pool:
+        results = list(pool.map(_rollup_shard, parts, [freq] * len(parts), [by] * len(parts)))
+    logging.info(f"partitioned rollup: {len(orders)} orders in {len(parts)} shards by {shard_by}, {processes} processes")
+    # шарды по месяцам делят неделю на стыке месяцев, поэтому частичные суммы складываются повторно.
+    # тип колонок by после concat зависит от шардирования (категории с разным набором значений дают object),
+    # поэтому схема применяется к итогу
+    totals = pd.concat(results).groupby(level=list(range(len(by) + 1)), observed=True).sum().reset_index()
+    return apply_schema(totals, ORDERS_SCHEMA)
@@ -0,0 +1,65 @@
+# источники цен для перевода балансов в USD
+import json
+import time
+import datetime
+import threading
+from instrumentation import instrumentation
+
+
+class QuotePriceProvider():
+    """
+    последние котировки из dxcore.quotes_history (TradingPlatform._get_last_quote) с TTL-кэшем,
+    кэш общий для всех объектов с одной и той же базой
+    """
+    _cache = dict()
+    _lock = threading.Lock()
+
+    def __init__(self, platform, ttl: int = 60):
+        self.platform = platform
+        self.ttl = ttl
+
+    def prices(self) -> dict:
+        """
+        вернет {символ: цена в USD}, например {'BTC': 65000.0, 'ETH': 3000.0, 'USDT': 1.0}
+        """
+        key = str(self.platform.engine_dxcore.url)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and time.monotonic() - cached[0] < self.ttl:
+                return cached[1]
+
+        quotes = self.platform._get_last_quote()
+        prices = dict(zip(quotes['event_symbol'].str.split('/').str[0], quotes['bid_price']))
+        prices['USDT'] = 1.0
+        with self._lock:
+            self._cache[key] = (time.monotonic(), prices)
+        return prices
+
+
+class FilePriceProvider():
+    """
+    цены из json-файла {"BTC": 65000, "ETH": 3000} - замена живым котировкам в тестах и офлайн-расчетах
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def prices(self) -> dict:
+        with open(self.path) as f:
+            prices = {symbol: float(price) for symbol, price in json.load(f).items()}
+        prices.setdefault('USDT', 1.0)
+        return prices
+
+
+class YahooPriceProvider():
+    """
+    цены закрытия BTC-USD и ETH-USD из yfinance за сегодня (прежнее поведение balance)
+    """
+    def prices(self) -> dict:
+        import yfinance as yf
+
+        prices = {'USDT': 1.0}
+        for symbol in ('BTC', 'ETH'):
+            with instrumentation.timed('http', f'yfinance {symbol}-USD'):
+                history = yf.Ticker(f"{symbol}-USD").history(start=f"{datetime.date.today()}")
+            prices[symbol] = history.reset_index().iloc[0]['Close']
+        return prices
@@ -0,0 +1,56 @@
+# параллельная сборка отчетов TradingPlatform по списку юзеров через один общий пул соединений
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from connections import Connection
+from users import TradingPlatform
+
+
+class MultiUserReport():
+    methods = ('login_info', 'get_users_orders', 'get_financial_transaction', 'positions', 'balance')
+
+    def __init__(self, users: list, methods: tuple = None, max_workers: int = 8, **platform_kwargs):
+        """
+        :param users: список юзеров, по каждому строится свой TradingPlatform
+        :param methods: методы TradingPlatform без аргументов, по умолчанию все основные отчеты
+        :param max_workers: число потоков, пул соединений dxcore ограничен тем же числом
+        :param platform_kwargs: freq, date_from, date_to и т.п. для TradingPlatform
+        """
+        self.users = list(users)
+        self.methods = tuple(methods or self.methods)
+        self.max_workers = max_workers
+        self.platform_kwargs = platform_kwargs
+        self.engine_dxcore = Connection().connect_dxcore(pool_size=max_workers, max_overflow=0)
+
+    def _run_one(self, user: str, method: str):
+        start = time.perf_counter()
+        try:
+            platform = TradingPlatform(user, engine=self.engine_dxcore, **self.platform_kwargs)
+            df, error = getattr(platform, method)(), None
+        # методы TradingPlatform завершаются через sys.exit, если по юзеру нет данных
+        except (SystemExit, Exception) as err:
+            logging.error(f"{method} for {user} failed: {err}")
+            df, error = None, repr(err)
+        return df, {'user': user, 'method': method, 'seconds': time.perf_counter() - start,
+                    'rows': 0 if df is None else len(df), 'error': error}
+
+    def run(self) -> dict:
+        """
+        вернет {метод: объединенный датафрейм по всем юзерам (колонка user), 'timings': время по юзеру и методу}
+        """
+        # курсы загружаются один раз до запуска потоков, дальше все берут их из локального кэша
+        TradingPlatform(self.users, engine=self.engine_dxcore, **self.platform_kwargs)._get_market_data()
+
+        tasks = [(user, method) for user in self.users for method in self.methods]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            results = list(pool.map(lambda task: self._run_one(*task), tasks))
+
+        report = {}
+        for method in self.methods:
+            frames = [df.reset_index(drop=df.index.name is None).assign(user=user)
+                      for (user, task_method), (df, _) in zip(tasks, results)
+                      if task_method == method and df is not None]
+            report[method] = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        report['timings'] = pd.DataFrame([timing for _, timing in results])
+        return report
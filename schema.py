@@ -0,0 +1,67 @@
+# типы колонок датафреймов TradingPlatform: категории для повторяющихся строк, даты и числа меньшей разрядности
+import pandas as pd
+
+
+# суммы (price, volume, pnl, markup, cost) остаются float64, чтобы не терять точность в денежных расчетах
+# идентификаторы - фиксированный int64: чанки и догрузки в parquet должны иметь одну схему
+ORDERS_SCHEMA = {
+    'user_id': 'category',
+    'account_id': 'category',
+    'order_symbol': 'category',
+    'pair_type': 'category',
+    'order_side': 'category',
+    'order_strategy': 'category',
+    'position_effect': 'category',
+    'order_id': 'int64',
+    'trade_time': 'datetime',
+    'transaction_time': 'datetime',
+    'created_time': 'datetime',
+    'quantity': 'float64',
+    'price': 'float64',
+    'bid_price': 'float64',
+    'volume': 'float64',
+    'pnl': 'float64',
+    'markup': 'float64',
+}
+
+POSITIONS_SCHEMA = {
+    'user_id': 'category',
+    'account_code': 'category',
+    'order_symbol': 'category',
+    'instrument_type': 'category',
+    'symbol': 'integer',
+    'opening_time': 'datetime',
+    'quantity': 'float64',
+    'cost': 'float64',
+}
+
+LOGINS_SCHEMA = {
+    'name': 'category',
+    'account_code': 'category',
+    'date': 'datetime',
+    'expire_at': 'datetime',
+}
+
+
+def apply_schema(df: pd.DataFrame, schema: dict) -> pd.DataFrame:
+    """
+    приводит колонки df к типам schema, отсутствующие в df колонки пропускаются
+    'integer' - минимальный целый тип, в который помещаются значения этого df (разный у разных выгрузок,
+    не для колонок, которые сохраняются или объединяются), 'datetime' - pd.to_datetime
+    """
+    df = df.copy()
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            continue
+        if dtype == 'integer':
+            df[column] = pd.to_numeric(df[column], downcast='integer')
+        elif dtype == 'datetime':
+            df[column] = pd.to_datetime(df[column])
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def memory_usage(df: pd.DataFrame) -> int:
+    # полный размер в байтах, включая строки в object-колонках
+    return int(df.memory_usage(deep=True).sum()) if df is not None else 0
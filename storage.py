@@ -0,0 +1,351 @@
+# локальные хранилища для данных, уже выгруженных из dxcore
+import os
+import sys
+import json
+import uuid
+import hashlib
+import sqlite3
+import datetime
+from contextlib import closing
+import pandas as pd
+
+
+CACHE_DIR = os.path.expanduser('~/.dealing_library')
+
+
+class FxRateCache:
+    """
+    дисковый кэш дневных курсов (transaction_time, quote_currency) -> bid_price
+    день считается загруженным, только если он уже закончился, сегодняшний курс всегда перезапрашивается
+    """
+    def __init__(self, path: str = os.path.join(CACHE_DIR, 'fx_rates.sqlite')):
+        self.path = path
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.execute("""
+                create table if not exists fx_rates (
+                    transaction_time text, quote_currency text, bid_price real,
+                    primary key (transaction_time, quote_currency))
+                """)
+            conn.execute("create table if not exists fx_days (transaction_time text primary key)")
+
+    def missing_days(self, dates: list) -> list:
+        """
+        вернет отсортированный список дней из dates, курсы за которые еще не загружались
+        """
+        with closing(sqlite3.connect(self.path)) as conn:
+            cached = {row[0] for row in conn.execute(
+                "select transaction_time from fx_days where transaction_time between ? and ?",
+                (min(dates), max(dates)))}
+        return sorted(set(dates) - cached)
+
+    def read(self, date_from: str, date_to: str) -> pd.DataFrame:
+        with closing(sqlite3.connect(self.path)) as conn:
+            df = pd.read_sql_query(
+                "select transaction_time, quote_currency, bid_price from fx_rates where transaction_time between ? and ?",
+                conn, params=(date_from, date_to))
+        df['transaction_time'] = pd.to_datetime(df['transaction_time']).dt.date
+        return df.astype({'bid_price': float})
+
+    def write(self, rates: pd.DataFrame, days: list):
+        """
+        :param rates: датафрейм transaction_time, quote_currency, bid_price
+        :param days: дни, которые запрашивались (в т.ч. без котировок), прошедшие помечаются загруженными
+        """
+        today = str(datetime.date.today())
+        rows = [(str(row.transaction_time), row.quote_currency, float(row.bid_price))
+                for row in rates.itertuples(index=False) if pd.notna(row.bid_price)]
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.executemany("insert or replace into fx_rates values (?, ?, ?)", rows)
+            conn.executemany("insert or ignore into fx_days values (?)",
+                             [(day,) for day in days if day < today])
+
+
+class OrderStore:
+    """
+    локальная копия выгрузки get_users_orders в parquet, разбитая на месячные партиции (month=YYYY-MM)
+    для каждой партиции хранится high-water mark по trade_time, новые ордера догружаются только после него
+    хранилище привязано к набору юзеров и date_from первой выгрузки (_scope.json), см. bind
+    """
+    def __init__(self, path: str = os.path.join(CACHE_DIR, 'orders')):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self._watermarks_path = os.path.join(self.path, '_watermarks.json')
+        self._scope_path = os.path.join(self.path, '_scope.json')
+
+    def scope(self):
+        """
+        вернет {'users': отсортированный список или None (все юзеры), 'date_from': ...}, None - хранилище не привязано
+        """
+        if not os.path.exists(self._scope_path):
+            return None
+        with open(self._scope_path) as f:
+            return json.load(f)
+
+    def covers(self, users: list = None, date_from: str = None) -> bool:
+        # в хранилище есть все ордера юзеров users начиная с date_from
+        scope = self.scope()
+        if scope is None:
+            return False
+        users_covered = scope['users'] is None or (users is not None and set(users) <= set(scope['users']))
+        return users_covered and str(date_from) >= scope['date_from']
+
+    def bind(self, users: list = None, date_from: str = None) -> dict:
+        """
+        пустое хранилище привязывается к users и date_from. непустое принимается, только если покрывает их,
+        иначе выгрузка юзеров или дней, которых в нем нет, молча пропала бы - нужен отдельный path
+        :return: scope хранилища, догрузка идет по нему, а не по запрошенному подмножеству
+        """
+        if self.watermarks():
+            if self.scope() is None:
+                sys.exit(f'order store {self.path} has no _scope.json, its users and date_from are unknown; '
+                         f'use another path')
+            if not self.covers(users, date_from):
+                sys.exit(f'order store {self.path} holds {self.scope()}, it does not cover users={users}, '
+                         f'date_from={date_from}; use another path')
+            return self.scope()
+        scope = {'users': sorted(users) if users else None, 'date_from': str(date_from)}
+        with open(self._scope_path, 'w') as f:
+            json.dump(scope, f, indent=2)
+        return scope
+
+    def watermarks(self) -> dict:
+        """
+        вернет {партиция: максимальный trade_time в ней}
+        """
+        if not os.path.exists(self._watermarks_path):
+            return {}
+        with open(self._watermarks_path) as f:
+            return json.load(f)
+
+    def watermark(self):
+        # догрузка идет после последней партиции, более ранние месяцы уже закрыты
+        marks = self.watermarks()
+        return marks[max(marks)] if marks else None
+
+    def append(self, orders: pd.DataFrame, since: dict = None) -> int:
+        """
+        дописывает подготовленные ордера (выход _prepare_orders) в партиции и сдвигает watermark
+        :param since: watermarks(), снятые до начала выгрузки. при потоковой догрузке фильтр идет по ним,
+        а не по watermark, сдвинутому предыдущим чанком: строки с тем же trade_time, что у последней строки
+        чанка (ноги и исполнения одной активности), иначе пропали бы
+        """
+        marks = self.watermarks()
+        since = marks if since is None else since
+        if orders.empty:
+            return 0
+        # строки старше watermark своей партиции уже лежат в хранилище. строки на самой границе
+        # дописываются повторно, такие дубли убираются при чтении
+        trade_time = pd.to_datetime(orders['trade_time'])
+        months = pd.to_datetime(orders['transaction_time']).dt.strftime('%Y-%m')
+        fresh = trade_time >= pd.to_datetime(months.map(since))
+        fresh |= months.map(since).isna()
+        orders, months = orders[fresh], months[fresh]
+        for month, part in orders.groupby(months):
+            part_dir = os.path.join(self.path, f'month={month}')
+            os.makedirs(part_dir, exist_ok=True)
+            part.to_parquet(os.path.join(part_dir, f'part-{uuid.uuid4().hex}.parquet'), index=False)
+            last = str(pd.to_datetime(part['trade_time']).max())
+            marks[month] = max(marks.get(month, last), last)
+
+        # watermark пишется после данных: при падении посреди записи часть ордеров догрузится повторно,
+        # такие дубли убираются при чтении
+        tmp_path = f'{self._watermarks_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(marks, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._watermarks_path)
+        return len(orders)
+
+    def read(self, users: list = None, date_from: str = None, date_to: str = None, columns: list = None) -> pd.DataFrame:
+        """
+        чтение из локального хранилища без обращения к dxcore, фильтры по партициям и user_id отдаются в parquet
+        """
+        filters = []
+        if users:
+            filters.append(('user_id', 'in', list(users)))
+        if date_from:
+            filters += [('month', '>=', str(date_from)[:7]), ('transaction_time', '>=', pd.Timestamp(date_from))]
+        if date_to:
+            filters += [('month', '<=', str(date_to)[:7]), ('transaction_time', '<=', pd.Timestamp(date_to))]
+        if not self.watermarks():
+            return pd.DataFrame(columns=columns)
+
+        df = (pd.read_parquet(self.path, columns=columns, filters=filters or None)
+              .drop(columns=['month'], errors='ignore')
+              .drop_duplicates(ignore_index=True))
+        if 'trade_time' in df.columns:
+            df = df.sort_values('trade_time', ignore_index=True)
+        return df
+
+
+class SnapshotStore:
+    """
+    снимки результатов TradingPlatform в Arrow IPC (без сжатия, чтобы читать через memory map без копирования)
+    имя файла - метод и хэш ключа (юзеры, период, freq и т.п.), сам ключ хранится в метаданных схемы
+    """
+    def __init__(self, path: str = os.path.join(CACHE_DIR, 'snapshots')):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def file(self, method: str, key: dict) -> str:
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        return os.path.join(self.path, f'{method}-{digest}.arrow')
+
+    def write(self, df: pd.DataFrame, method: str, key: dict) -> str:
+        import pyarrow as pa
+
+        # именованный индекс (user_id у balance) сохраняется колонкой, безымянный RangeIndex отбрасывается
+        if df.index.name is not None or isinstance(df.index, pd.MultiIndex):
+            df = df.reset_index()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                               b'snapshot_key': json.dumps(key, sort_keys=True, default=str).encode()})
+        path = self.file(method, key)
+        tmp_path = f'{path}.tmp'
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, path)
+        return path
+
+    def exists(self, method: str, key: dict) -> bool:
+        return os.path.exists(self.file(method, key))
+
+    def read(self, method: str, key: dict, columns: list = None, users: list = None,
+             date_from: str = None, date_to: str = None) -> pd.DataFrame:
+        """
+        открывает снимок через memory map, фильтрует по user_id и transaction_time и оставляет только columns,
+        в pandas переводится только итоговый срез
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        with pa.memory_map(self.file(method, key), 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+            mask = None
+            if users and 'user_id' in table.column_names:
+                user_id = table['user_id']
+                if pa.types.is_dictionary(user_id.type):
+                    user_id = user_id.cast(user_id.type.value_type)
+                mask = pc.is_in(user_id, value_set=pa.array([str(user) for user in users]))
+            for bound, compare in ((date_from, pc.greater_equal), (date_to, pc.less_equal)):
+                if bound and 'transaction_time' in table.column_names:
+                    # у Timestamp из строки даты единица 's' (pandas >= 2), граница приводится к типу колонки
+                    bound = pa.scalar(pd.Timestamp(bound).to_datetime64().astype('datetime64[ns]')).cast(table.schema.field('transaction_time').type)
+                    condition = compare(table['transaction_time'], bound)
+                    mask = condition if mask is None else pc.and_(mask, condition)
+            if mask is not None:
+                table = table.filter(mask)
+            if columns:
+                table = table.select(columns)
+            return table.to_pandas()
+
+
+class UserMetaCache:
+    """
+    локальная копия метаданных юзеров: principals, accounts, user_sessions и категории register api
+    таблицы dxcore догружаются по watermark: principals - по created_time, accounts - по id.
+    сессии, истекшие до прошлой догрузки, уже не меняются, поэтому заново запрашиваются и заменяются только
+    сессии с expire_at не раньше времени сервера на момент прошлой догрузки (новые и продленные)
+    один файл на базу, см. for_database
+    """
+    def __init__(self, path: str = os.path.join(CACHE_DIR, 'user_meta.sqlite')):
+        self.path = path
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.execute("create table if not exists principals (id integer primary key, name text, created_time text)")
+            conn.execute("create index if not exists principals_name on principals (name)")
+            conn.execute("create table if not exists accounts (id integer primary key, account_code text, owner_id integer)")
+            conn.execute("create index if not exists accounts_owner on accounts (owner_id)")
+            conn.execute("""
+                create table if not exists sessions (
+                    user_id integer, expire_at text,
+                    primary key (user_id, expire_at))
+                """)
+            conn.execute("create table if not exists categories (name text primary key, fetched_at real, payload text)")
+            conn.execute("create table if not exists meta (key text primary key, value text)")
+
+    @classmethod
+    def for_database(cls, url: str):
+        # кэш с данными одной базы не должен отвечать за другую: имя файла - хэш url без пароля
+        digest = hashlib.sha1(url.encode()).hexdigest()[:16]
+        return cls(os.path.join(CACHE_DIR, f'user_meta-{digest}.sqlite'))
+
+    def watermarks(self) -> dict:
+        """
+        вернет {'principals': max created_time, 'accounts': max id, 'sessions': время сервера прошлой догрузки},
+        None - еще не загружалось
+        """
+        with closing(sqlite3.connect(self.path)) as conn:
+            sessions = conn.execute("select value from meta where key = 'sessions_since'").fetchone()
+            return {'principals': conn.execute("select max(created_time) from principals").fetchone()[0],
+                    'accounts': conn.execute("select max(id) from accounts").fetchone()[0],
+                    'sessions': sessions[0] if sessions else None}
+
+    def refreshed_at(self):
+        with closing(sqlite3.connect(self.path)) as conn:
+            row = conn.execute("select value from meta where key = 'refreshed_at'").fetchone()
+        return float(row[0]) if row else None
+
+    def write(self, principals: pd.DataFrame, accounts: pd.DataFrame, sessions: pd.DataFrame, refreshed_at: float,
+              sessions_since: str = None, server_time: str = None):
+        """
+        :param principals: id, name, created_time; accounts: id, account_code, owner_id; sessions: user_id, expire_at
+        :param sessions_since: сессии запрошены с expire_at не раньше этого времени (None - все),
+            сохраненные сессии этого окна заменяются запрошенными
+        :param server_time: время сервера в начале догрузки, следующая догрузка сессий начнется с него
+        """
+        def text(value):
+            return None if pd.isna(value) else str(value)
+
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.executemany("insert or replace into principals values (?, ?, ?)",
+                             [(int(row.id), row.name, text(row.created_time)) for row in principals.itertuples(index=False)])
+            conn.executemany("insert or replace into accounts values (?, ?, ?)",
+                             [(int(row.id), row.account_code, int(row.owner_id))
+                              for row in accounts.itertuples(index=False) if pd.notna(row.owner_id)])
+            if sessions_since is None:
+                conn.execute("delete from sessions")
+            else:
+                conn.execute("delete from sessions where expire_at >= ? or expire_at is null", (sessions_since,))
+            conn.executemany("insert or ignore into sessions values (?, ?)",
+                             [(int(row.user_id), text(row.expire_at)) for row in sessions.itertuples(index=False)])
+            conn.execute("insert or replace into meta values ('refreshed_at', ?)", (str(refreshed_at),))
+            if server_time is not None:
+                conn.execute("insert or replace into meta values ('sessions_since', ?)", (server_time,))
+
+    def logins(self, users: list = None, sessions_from: str = None) -> pd.DataFrame:
+        """
+        то же, что TradingPlatform.login_info: name, account_code, date (день регистрации), expire_at
+        """
+        conditions, params = [], []
+        if users:
+            conditions.append(f"principals.name in ({', '.join('?' * len(users))})")
+            params += list(users)
+        if sessions_from:
+            conditions.append("sessions.expire_at >= ?")
+            params.append(str(sessions_from))
+        where = f"where {' and '.join(conditions)}" if conditions else ''
+        with closing(sqlite3.connect(self.path)) as conn:
+            return pd.read_sql_query(f"""
+                select distinct principals.name, accounts.account_code, substr(principals.created_time, 1, 10) as date,
+                    sessions.expire_at
+                from sessions
+                join principals on sessions.user_id = principals.id
+                join accounts on accounts.owner_id = principals.id
+                {where}
+                """, conn, params=params)
+
+    def categories(self, name: str, ttl: float):
+        """
+        вернет сохраненный ответ register api для юзера, если он моложе ttl секунд, иначе None
+        """
+        with closing(sqlite3.connect(self.path)) as conn:
+            row = conn.execute("select fetched_at, payload from categories where name = ?", (name,)).fetchone()
+        if row is None or datetime.datetime.now().timestamp() - row[0] > ttl:
+            return None
+        return json.loads(row[1])
+
+    def write_categories(self, name: str, payload):
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.execute("insert or replace into categories values (?, ?, ?)",
+                         (name, datetime.datetime.now().timestamp(), json.dumps(payload)))
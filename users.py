@@ -1,105 +1,298 @@
-from connections import Connection
+from connections import Connection, token_provider, http_session, fan_out, read_config
+from storage import FxRateCache, OrderStore, SnapshotStore, UserMetaCache
+from prices import QuotePriceProvider
+from instrumentation import instrumentation, statement
+from schema import apply_schema, memory_usage, ORDERS_SCHEMA, POSITIONS_SCHEMA, LOGINS_SCHEMA
 import datetime
+import time
+import threading
 import pandas as pd
-import ast
 import warnings
 import sys
-import configparser
-import requests
-from requests.auth import HTTPBasicAuth
 import json
-import yfinance as yf
-from sqlalchemy import text
 
 
 class TradingPlatform():
     up = list()
-
-    def __init__(self, users: str=None, freq='W-MON', date_from: str='2023-03-01', date_to=datetime.date.today()):
+    # кэш get_last_quotes, общий для всех объектов: (url базы, символы) -> (время запроса, датафрейм)
+    _quotes_cache = dict()
+    _quotes_lock = threading.Lock()
+    # одна догрузка метаданных юзеров за раз, например при MultiUserReport по нескольким юзерам
+    _meta_lock = threading.Lock()
+
+    def __init__(self, users: str=None, freq='W-MON', date_from: str='2023-03-01', date_to=None,
+                 fx_cache: bool=True, engine=None, meta_cache: bool=True):
+        """
+        конструктор не обращается к базе и диску: engine, кэш курсов и список дат создаются при первом обращении
+        :param date_to: None - сегодня на момент создания объекта
+        """
+        # юзеры передаются параметром :users (см. _params), текст запроса не зависит от набора юзеров
         if isinstance(users, list) == True:
             if len(users) > 1:
                 self.up = tuple(users)
-                self.user_req_cond = f"principals.name in {self.up}"
+                self.user_req_cond = "principals.name = any(:users)"
             elif len(users) == 1:
                 self.up = users[0]
-                self.user_req_cond = f"principals.name = '{self.up}'"
+                self.user_req_cond = "principals.name = any(:users)"
         elif isinstance(users, str) == True:
             self.up = users
-            self.user_req_cond = f"principals.name = '{self.up}'"
+            self.user_req_cond = "principals.name = any(:users)"
         elif users is None:
-            self.user_req_cond = f"principals.name is not null"
+            self.user_req_cond = "principals.name is not null"
         else:
             sys.exit('Datatype error, should be str or list format')
 
         self.date_from = date_from
-        self.date_to = str(date_to)
-        dates = list()
-        for date in pd.date_range(start=self.date_from, end=datetime.date.today()):
-            dates.append(date.strftime("%Y-%m-%d"))
-        self.dates = dates
-        connect = Connection()
-        self.engine_dxcore = connect.connect_dxcore()
+        self.date_to = str(date_to if date_to is not None else datetime.date.today())
+        self._dates = None
+        # engine можно передать общий, чтобы несколько объектов работали через один пул соединений
+        self._engine = engine
         self.freq = freq
+        # fx_cache=False - курсы всегда запрашиваются из quotes_history
+        self._use_fx_cache = fx_cache
+        self._fx_cache = None
+        # meta_cache=False - login_info и категории всегда запрашиваются из dxcore и register api
+        self._use_meta_cache = meta_cache
+        self._meta_cache = None
+        self.memory_log = list()
+
+    @property
+    def dates(self) -> list:
+        if self._dates is None:
+            self._dates = [date.strftime("%Y-%m-%d")
+                           for date in pd.date_range(start=self.date_from, end=datetime.date.today())]
+        return self._dates
+
+    @property
+    def engine_dxcore(self):
+        if self._engine is None:
+            self._engine = Connection().connect_dxcore()
+        return self._engine
+
+    @property
+    def fx_cache(self):
+        if self._use_fx_cache and self._fx_cache is None:
+            self._fx_cache = FxRateCache()
+        return self._fx_cache
+
+    @property
+    def meta_cache(self):
+        if self._use_meta_cache and self._meta_cache is None:
+            self._meta_cache = UserMetaCache.for_database(self.engine_dxcore.url.render_as_string(hide_password=True))
+        return self._meta_cache
+
+    def _track(self, method: str, df):
+        # размер результата каждого вызова, см. memory_report
+        self.memory_log.append({'method': method, 'rows': 0 if df is None else len(df), 'bytes': memory_usage(df),
+                                'time': datetime.datetime.now()})
+        return df
+
+    def memory_report(self) -> pd.DataFrame:
+        """
+        вернет датафрейм method, rows, bytes, mb, time по всем выгрузкам этого объекта
+        """
+        report = pd.DataFrame(self.memory_log, columns=['method', 'rows', 'bytes', 'time'])
+        report['mb'] = report['bytes'] / 2 ** 20
+        return report
+
+    def _users(self):
+        # список юзеров из конструктора, None - все юзеры
+        if isinstance(self.up, str):
+            return [self.up]
+        return list(self.up) or None
+
+    def _params(self, **params) -> dict:
+        """
+        значения параметров запросов: :users, :date_from, :date_to и дополнительные params.
+        значения не подставляются в текст, поэтому для любых юзеров и дат сервер получает один и тот же запрос
+        """
+        return {'users': self._users(), 'date_from': str(self.date_from), 'date_to': self.date_to, **params}
+
+    def _read_sql(self, req: str, name: str, columns: list = None, params: dict = None) -> pd.DataFrame:
+        # все запросы к dxcore идут через общий журнал замеров instrumentation
+        return instrumentation.read_sql(self.engine_dxcore, req, name, columns, self._params(**(params or {})))
+
+    def _snapshot_key(self, method_kwargs: dict) -> dict:
+        # снимок определяется набором юзеров, периодом, freq и аргументами метода
+        return {'users': sorted(self._users() or []), 'date_from': str(self.date_from), 'date_to': self.date_to,
+                'freq': self.freq, 'kwargs': method_kwargs}
+
+    def save_snapshot(self, method: str = 'get_users_orders', store: SnapshotStore = None, **method_kwargs) -> str:
+        """
+        выполняет method (get_users_orders, get_financial_transaction, ...) и сохраняет результат в Arrow IPC
+        :return: путь к файлу снимка
+        """
+        store = store or SnapshotStore()
+        return store.write(getattr(self, method)(**method_kwargs), method, self._snapshot_key(method_kwargs))
+
+    def load_snapshot(self, method: str = 'get_users_orders', columns: list = None, users: list = None,
+                      date_from: str = None, date_to: str = None, store: SnapshotStore = None,
+                      **method_kwargs) -> pd.DataFrame:
+        """
+        читает сохраненный save_snapshot результат без обращения к базе
+        :param columns: только эти колонки
+        :param users: срез по user_id, date_from/date_to - по transaction_time
+        """
+        store = store or SnapshotStore()
+        key = self._snapshot_key(method_kwargs)
+        if not store.exists(method, key):
+            sys.exit(f'no snapshot for {method} with {key}')
+        return store.read(method, key, columns=columns, users=users, date_from=date_from, date_to=date_to)
 
     def _get_market_data(self):
-        if len(self.dates) == 1:
-            date_cond_req = f"and bid_time::TIMESTAMP::DATE = '{self.dates[0]}'"
-        elif len(self.dates) > 1:
-            date_cond_req = f"and bid_time::TIMESTAMP::DATE in {tuple(self.dates)}"
-        else:
+        """
+        дневные курсы к USD за self.dates, уже загруженные дни берутся из локального кэша
+        """
+        if not self.dates:
             sys.exit('No dates from orders dataframe - orders df is empty')
-
+        if self.fx_cache is None:
+            return self._fetch_market_data(self.dates[0], self.dates[-1])
+
+        # пропущенные дни запрашиваются непрерывными отрезками, уже загруженные дни между ними не перечитываются
+        runs = []
+        for day in self.fx_cache.missing_days(self.dates):
+            if runs and datetime.date.fromisoformat(day) - datetime.date.fromisoformat(runs[-1][-1]) == datetime.timedelta(days=1):
+                runs[-1].append(day)
+            else:
+                runs.append([day])
+        for run in runs:
+            self.fx_cache.write(self._fetch_market_data(run[0], run[-1]), run)
+        return self.fx_cache.read(self.dates[0], self.dates[-1])
+
+    def _market_data_request(self, day_to: bool = True):
+        # диапазон по bid_time (:day_from, :day_to) без приведения типа, чтобы работал индекс,
+        # берется первая котировка дня
+        day_to_cond = "and bid_time < :day_to" if day_to else ''
         req = f"""
-        select bid_time::TIMESTAMP::DATE as transaction_time, trim('USD/|/USD' from event_symbol) as quote_currency,
+        select distinct on (bid_time::TIMESTAMP::DATE, event_symbol)
+            bid_time::TIMESTAMP::DATE as transaction_time, trim('USD/|/USD' from event_symbol) as quote_currency,
             case
                 when event_symbol in ('USD/JPY', 'USD/CNH', 'USD/MXN') then (1/bid_price)
                 when event_symbol in ('BTC/USD', 'ETH/USD', 'EUR/USD', 'GBP/USD') then bid_price
             end as bid_price
         from dxcore.dxcore.quotes_history qh 
         where event_symbol in ('BTC/USD', 'ETH/USD', 'EUR/USD', 'GBP/USD', 'USD/JPY', 'USD/CNH', 'USD/MXN')
-        {date_cond_req}
+        and bid_time >= :day_from {day_to_cond}
+        order by bid_time::TIMESTAMP::DATE, event_symbol, bid_time
             """
-        with self.engine_dxcore.connect() as conn:
-            df = pd.DataFrame(conn.execute(text(req))).drop_duplicates(subset=['transaction_time', 'quote_currency'])
+        return req
+
+    def _fetch_market_data(self, day_from: str, day_to: str):
+        day_to = datetime.datetime.strptime(day_to, '%Y-%m-%d').date() + datetime.timedelta(days=1)
+        df = self._read_sql(self._market_data_request(), '_get_market_data',
+                            columns=['transaction_time', 'quote_currency', 'bid_price'],
+                            params={'day_from': day_from, 'day_to': str(day_to)})
         df = df.astype({'bid_price': float})
         return df
 
-    def _get_last_quote(self):
-        req = f"""
-        SELECT event_symbol, snapshot_time, bid_price
-        FROM ( SELECT event_symbol, snapshot_time, bid_price, ROW_NUMBER() OVER (PARTITION BY event_symbol ORDER BY snapshot_time DESC) 
-            as row_num FROM dxcore.dxcore.quotes_history ) as subquery
-        WHERE row_num = 1 and event_symbol in ('BTC/USD', 'ETH/USD')
+    def get_last_quotes(self, symbols: list = ('BTC/USD', 'ETH/USD'), ttl: float = 5):
+        """
+        последняя котировка по каждому символу: отдельный order by snapshot_time desc limit 1 на символ
+        через lateral вместо сортировки всей quotes_history, результат кэшируется в процессе на ttl секунд
+        :return: датафрейм event_symbol, snapshot_time, bid_price
+        """
+        key = (str(self.engine_dxcore.url), tuple(sorted(symbols)))
+        with self._quotes_lock:
+            cached = self._quotes_cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < ttl:
+            return cached[1].copy()
+
+        req = """
+        SELECT symbols.event_symbol, last_quote.snapshot_time, last_quote.bid_price
+        FROM unnest(cast(:symbols as text[])) as symbols(event_symbol)
+        CROSS JOIN LATERAL (
+            SELECT snapshot_time, bid_price FROM dxcore.dxcore.quotes_history qh
+            WHERE qh.event_symbol = symbols.event_symbol
+            ORDER BY snapshot_time DESC
+            LIMIT 1) as last_quote
             """
-        with self.engine_dxcore.connect() as conn:
-            df = pd.DataFrame(conn.execute(text(req)))
+        df = self._read_sql(req, 'get_last_quotes', columns=['event_symbol', 'snapshot_time', 'bid_price'],
+                            params={'symbols': list(key[1])})
         df = df.astype({'bid_price': float})
-        return df
+        with self._quotes_lock:
+            self._quotes_cache[key] = (time.monotonic(), df)
+        return df.copy()
 
-    def login_info(self):
+    def _get_last_quote(self):
+        return self.get_last_quotes(('BTC/USD', 'ETH/USD'))
+
+    def _refresh_user_meta(self, refresh_ttl: float):
+        """
+        догружает в meta_cache principals, accounts и user_sessions новее сохраненных watermark,
+        не чаще раза в refresh_ttl секунд. первая догрузка выгружает эти таблицы целиком (с 2023-02-01)
+        """
+        with self._meta_lock:
+            refreshed_at = self.meta_cache.refreshed_at()
+            if refreshed_at is not None and time.time() - refreshed_at < refresh_ttl:
+                return
+            started_at = time.time()
+            marks = self.meta_cache.watermarks()
+            server_time = str(self._read_sql("select localtimestamp", 'login_info[server_time]').iloc[0, 0])
+            principals = self._read_sql("""
+                select id, name, created_time from dxcore.dxcore.principals
+                where created_time >= :since
+                """, 'login_info[principals]', params={'since': marks['principals'] or '2023-02-01'})
+            accounts = self._read_sql("""
+                select id, account_code, owner_id from dxcore.dxcore.accounts
+                where id > :since
+                """, 'login_info[accounts]', params={'since': marks['accounts'] or -1})
+            sessions_cond = ("and (user_sessions.expire_at >= :since or user_sessions.expire_at is null)"
+                             if marks['sessions'] else '')
+            sessions = self._read_sql(f"""
+                select distinct user_sessions.user_id, user_sessions.expire_at
+                from dxcore.dxcore.user_sessions as user_sessions
+                inner join dxcore.dxcore.principals as principals on user_sessions.user_id = principals.id
+                where principals.created_time >= '2023-02-01'
+                {sessions_cond}
+                """, 'login_info[sessions]', params={'since': marks['sessions']})
+            self.meta_cache.write(principals, accounts, sessions, started_at, marks['sessions'], server_time)
+
+    def login_info(self, sessions_from: str = None, refresh_ttl: float = 300):
+        """
+        сессии юзеров: name, account_code, date (день регистрации), expire_at
+        :param sessions_from: только сессии с expire_at не раньше этой даты
+        :param refresh_ttl: с meta_cache - как часто догружать новые записи из dxcore, секунд
+        meta_cache используется, когда он уже заполнен: первую, полную выгрузку таблиц делает login_info
+        по всем юзерам (users=None), для отдельных юзеров до этого запрос идет напрямую в dxcore
+        """
+        if self.meta_cache is not None and (self._users() is None or self.meta_cache.refreshed_at() is not None):
+            self._refresh_user_meta(refresh_ttl)
+            with instrumentation.timed('pandas', 'login_info') as probe:
+                logins = apply_schema(self.meta_cache.logins(self._users(), sessions_from), LOGINS_SCHEMA)
+                probe['rows'] = len(logins)
+            return self._track('login_info', logins)
+
+        sessions_cond = "and user_sessions.expire_at >= :sessions_from" if sessions_from else ''
         req = f"""
-        select principals.name, accounts.account_code, principals.created_time::DATE as DATE, expire_at
+        select distinct principals.name, accounts.account_code, principals.created_time::DATE as DATE, expire_at
         from dxcore.dxcore.user_sessions as user_sessions
-        left join dxcore.dxcore.principals as principals on user_sessions.user_id = principals.id
-        right join dxcore.dxcore.accounts as accounts on accounts.owner_id = principals.id 
+        inner join dxcore.dxcore.principals as principals on user_sessions.user_id = principals.id
+        inner join dxcore.dxcore.accounts as accounts on accounts.owner_id = principals.id
         where principals.created_time >= '2023-02-01'
         and {self.user_req_cond}
+        {sessions_cond}
         """
-        with self.engine_dxcore.connect() as conn:
-            logins = pd.DataFrame(conn.execute(text(req))).drop_duplicates()
-        logins['date'], logins['expire_at'] = pd.to_datetime(logins['date']),  pd.to_datetime(logins['expire_at'])
-        return logins
-
-    def get_users_orders(self):
+        logins = self._read_sql(req, 'login_info', params={'sessions_from': sessions_from})
+        with instrumentation.timed('pandas', 'login_info'):
+            logins = apply_schema(logins, LOGINS_SCHEMA)
+        return self._track('login_info', logins)
+
+    def _orders_request(self, since: str = None, distinct: str = ''):
+        # since - догрузка только активностей не старше high-water mark локального хранилища: активности
+        # с тем же transaction_time могли закоммитить после прошлой выгрузки, повторы убирает OrderStore.read
+        # distinct='distinct' - дубликаты строк join убираются в базе (для потоковой выгрузки, где
+        # drop_duplicates видит только один чанк); pair_type поэтому текст (->>), а не json
+        since_cond = "and activities.transaction_time >= :since" if since else ''
         req = f"""
-            select
+            select {distinct}
             principals.name as user_id,
             accounts.account_code as account_id,
             order_instrument.symbol as order_symbol,
             split_part(order_instrument.symbol, '/', 2) as symbol,
-            order_instrument.additional_fields::json->-0->'val' as pair_type,
+            order_instrument.additional_fields::json->0->>'val' as pair_type,
             orders.order_side,
-            activities.order_id as order_id, orders.created_time, orders.parameters,
+            activities.order_id as order_id, orders.created_time,
+            orders.parameters::json->>'ORDER_EXEC_STRATEGY_NAME' as order_strategy,
             coalesce(order_legs.position_code, activity_legs.position_code, activities.linked_position_code, '') as position_code,
             abs(activity_legs.quantity) as quantity, activities.transaction_time,
             order_legs.price as price,
@@ -137,48 +330,49 @@ class TradingPlatform():
             left join
                 dxcore.dxcore.order_legs hedge on hedge.order_id = hedge_order.hedge_id
             where
-              (activities.transaction_time::DATE between '{self.date_from}' and '{datetime.datetime.strptime(self.date_to, '%Y-%m-%d') + datetime.timedelta(days=1)}') -- #- datetime.timedelta(days=1)
+              (activities.transaction_time::DATE between cast(:date_from as date) and cast(:date_to as date) + 1)
             and
                 activities.activity_type = 'TRADE'
             and 
                 {self.user_req_cond}
+            {since_cond}
             order by
                 activities.transaction_time asc
             """
-        with self.engine_dxcore.connect() as conn:
-            orders = pd.DataFrame(conn.execute(text(req)))
-
-            if orders.empty:
-                sys.exit('orders dataframe is empty')
-
-            orders = (orders.drop_duplicates()
-                     .astype({
-                            'quantity': float,
-                            'price': float,
-                            'pnl_4': float,
-                            'pnl_3': float,
-                            'pnl_2': float,
-                            'pnl_1': float,
-                            'markup': float
-                            })
-                    )
+        return req
 
+    @staticmethod
+    def _prepare_orders(orders, market_data):
+        """
+        типизация, стратегия ордера и перевод объема, pnl и markup в USD для выгрузки (или ее части),
+        staticmethod - вызывается и в процессах partitioned.py
+        """
+        orders = (orders.drop_duplicates()
+                 .astype({
+                        'quantity': float,
+                        'price': float,
+                        'pnl_4': float,
+                        'pnl_3': float,
+                        'pnl_2': float,
+                        'pnl_1': float,
+                        'markup': float
+                        })
+                )
+
+        # стратегия ордера приходит из sql (parameters->>'ORDER_EXEC_STRATEGY_NAME') и не участвует в замене
+        strategy = orders.pop('order_strategy')
         orders = orders.replace({'Forex Majors': 'Forex',
                                  'Forex Minors': 'Forex',
                                  'Forex Metals': 'Forex',
                                  'Indices': 'Equities',
                                  'MANUAL': 'FX_STP'})
-
-        # getting orders strategy
-        parameters = orders['parameters'].apply(lambda x: ast.literal_eval(x)).apply(pd.Series)
-        orders['order_strategy'] = parameters['ORDER_EXEC_STRATEGY_NAME']
+        orders['order_strategy'] = strategy
 
         orders['quote_currency'] = orders['order_symbol'].str.extract('/(.*)').fillna('USD').replace('USDT', 'USD')
         orders['trade_time'] = orders['transaction_time']
         orders['transaction_time'] = pd.to_datetime(orders['transaction_time']).dt.date
 
-        _market_data = self._get_market_data()
-        orders = orders.merge(_market_data, how='left', on=['transaction_time', 'quote_currency'])
+        orders = orders.merge(market_data, how='left', on=['transaction_time', 'quote_currency'])
         orders['transaction_time'] = pd.to_datetime(orders['transaction_time'])
         orders['bid_price'] = orders['bid_price'].fillna(1)
 
@@ -187,12 +381,102 @@ class TradingPlatform():
         orders['pnl'] = (orders['pnl_1'] + orders['pnl_2'] + orders['pnl_3'] + orders['pnl_4']) * orders['bid_price']
         orders['markup'] = orders['markup'] * orders['bid_price']
         orders = orders.drop(columns={
-            'pnl_1', 'pnl_2', 'pnl_3', 'pnl_4', 'symbol', 'parameters', 'quote_currency'})
-        return orders
+            'pnl_1', 'pnl_2', 'pnl_3', 'pnl_4', 'symbol', 'quote_currency'})
+        return apply_schema(orders, ORDERS_SCHEMA)
+
+    def get_users_orders(self, store: OrderStore = None):
+        """
+        :param store: локальное хранилище ордеров - в него догружаются только новые активности,
+            а результат читается уже из него
+        """
+        if store is not None:
+            self.sync_orders(store)
+            orders = store.read(users=self._users(), date_from=self.date_from,
+                                date_to=datetime.datetime.strptime(self.date_to, '%Y-%m-%d') + datetime.timedelta(days=1))
+            if orders.empty:
+                sys.exit('orders dataframe is empty')
+            return self._track('get_users_orders', apply_schema(orders, ORDERS_SCHEMA))
+
+        orders = self._read_sql(self._orders_request(), 'get_users_orders')
+        if orders.empty:
+            sys.exit('orders dataframe is empty')
+
+        market_data = self._get_market_data()
+        with instrumentation.timed('pandas', 'get_users_orders') as probe:
+            orders = self._prepare_orders(orders, market_data)
+            probe['rows'] = len(orders)
+        return self._track('get_users_orders', orders)
 
-    def get_financial_transaction(self, sort_time=True):
+    def iter_users_orders(self, chunk_size: int = 100_000, since: str = None):
+        """
+        потоковая выгрузка ордеров через серверный курсор: вернет генератор датафреймов по chunk_size строк,
+        каждый уже типизирован и переведен в USD. дубликаты убираются в запросе (select distinct),
+        поэтому дубли на границе чанков не попадают в суммы get_orders_rollup
+        """
+        market_data = self._get_market_data()
+        with self.engine_dxcore.connect() as conn:
+            result = (conn.execution_options(stream_results=True, yield_per=chunk_size)
+                      .execute(statement(self._orders_request(since, distinct='distinct')), self._params(since=since)))
+            columns = list(result.keys())
+            start = time.perf_counter()
+            for rows in result.partitions():
+                instrumentation.record('sql', 'iter_users_orders', time.perf_counter() - start, len(rows))
+                with instrumentation.timed('pandas', 'iter_users_orders') as probe:
+                    chunk = self._prepare_orders(pd.DataFrame(rows, columns=columns), market_data)
+                    probe['rows'] = len(chunk)
+                yield chunk
+                start = time.perf_counter()
+
+    def sync_orders(self, store: OrderStore, chunk_size: int = 100_000) -> int:
+        """
+        инкрементальная выгрузка в локальное хранилище: запрашиваются только активности не старше его watermark.
+        догружаются все юзеры и дни хранилища (store.bind), а не только юзеры этого объекта,
+        иначе watermark сдвинулся бы дальше ордеров остальных юзеров
+        :return: число дописанных строк
+        """
+        scope = store.bind(self._users(), self.date_from)
+        platform = TradingPlatform(scope['users'], freq=self.freq, date_from=scope['date_from'], engine=self.engine_dxcore,
+                                   fx_cache=self._use_fx_cache, meta_cache=self._use_meta_cache)
+        # watermarks снимаются один раз: чанки фильтруются по состоянию до выгрузки, а не по сдвинутому предыдущим чанком
+        marks, since = store.watermarks(), store.watermark()
+        return sum(store.append(chunk, since=marks) for chunk in platform.iter_users_orders(chunk_size, since=since))
+
+    def get_orders_rollup(self, by: list = None, chunk_size: int = 100_000):
+        """
+        недельные (self.freq) суммы volume, pnl, markup и число сделок, посчитанные по чанкам iter_users_orders
+        без загрузки всей выгрузки в память
+        :param by: дополнительные колонки группировки, например ['user_id']
+        """
+        keys = [pd.Grouper(key='transaction_time', freq=self.freq, closed='left')] + list(by or [])
+        parts = [chunk.groupby(keys, observed=True).agg(volume=('volume', 'sum'), pnl=('pnl', 'sum'),
+                                         markup=('markup', 'sum'), trades=('order_id', 'count'))
+                 for chunk in self.iter_users_orders(chunk_size)]
+        if not parts:
+            sys.exit('orders dataframe is empty')
+        # чанк может закончиться посреди недели, поэтому частичные суммы складываются повторно
+        return pd.concat(parts).groupby(level=list(range(len(keys))), observed=True).sum().reset_index()
+
+    def get_orders_rollup_partitioned(self, by: list = None, shard_by: str = 'user_id', processes: int = None):
+        """
+        то же, что get_orders_rollup, но перевод в USD и суммы считаются в пуле процессов по шардам выгрузки,
+        курсы передаются воркерам через shared memory (см. partitioned.py)
+        :param shard_by: 'user_id' или 'month'
+        :param processes: число процессов, по умолчанию число ядер
+        """
+        import partitioned
+
+        orders = self._read_sql(self._orders_request(), 'get_orders_rollup_partitioned')
+        if orders.empty:
+            sys.exit('orders dataframe is empty')
+        market_data = self._get_market_data()
+        with instrumentation.timed('pandas', 'get_orders_rollup_partitioned') as probe:
+            rollup = partitioned.rollup(orders, market_data, self.freq, by, shard_by, processes)
+            probe['rows'] = len(rollup)
+        return self._track('get_orders_rollup_partitioned', rollup)
+
+    def _financial_request(self, distinct: str = ''):
         req = f"""
-        SELECT account_code, activity_type, activities.created_time::DATE as transaction_time, activities.created_time as date_time, principals.name as user_id, activities.description, 
+        SELECT {distinct} account_code, activity_type, activities.created_time::DATE as transaction_time, activities.created_time as date_time, principals.name as user_id, activities.description, 
         trim(trailing '$' FROM instruments.symbol) AS quote_currency, activity_legs.quantity as amount
         FROM dxcore.dxcore.activity_legs
         LEFT JOIN dxcore.dxcore.activities ON activities.id = activity_legs.activity_id
@@ -203,79 +487,220 @@ class TradingPlatform():
         and (activities.description not similar to ('%%(demo|Demo|test_|Test_|hedge|Hedge)%%') or activities.description is null)
         and activities.action_code not like '%%COMP%%'
         and accounts.clearing_code = 'LIVE'   
-        and activities.created_time::DATE >= '{self.date_from}'
+        and activities.created_time::DATE >= cast(:date_from as date)
         and {self.user_req_cond}
-        ORDER BY activities.created_time desc
         """
-        with self.engine_dxcore.connect() as conn:
-            df = pd.DataFrame(conn.execute(text(req))).drop_duplicates()
+        return req
+
+    def _sql_period(self, column: str):
+        """
+        sql-выражение периода для column, совпадающее с pd.Grouper(freq=self.freq, closed='left'),
+        None - если частота не поддерживается
+        """
+        weekdays = ['MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT', 'SUN']
+        freq = 'W-SUN' if self.freq == 'W' else self.freq
+        if freq.startswith('W-') and freq[2:] in weekdays:
+            # неделя [якорный день, следующий якорный день), метка - правая граница
+            shift = weekdays.index(freq[2:])
+            return f"(date_trunc('week', {column} - interval '{shift} days') + interval '{shift + 7} days')::DATE"
+        if freq == 'D':
+            return f"{column}::DATE"
+        if freq == 'MS':
+            return f"date_trunc('month', {column})::DATE"
+        return None
+
+    def _get_financial_aggregated(self, period: str):
+        # дедупликация, курс, период и суммы по activity_type считаются в базе, приходит только сводная таблица
+        activity_types = ['ADJUSTMENT', 'DEPOSIT', 'FINANCING', 'WITHDRAWAL']
+        sums = ',\n            '.join(
+            f"sum(legs.amount * coalesce(rates.bid_price, 1)) filter (where legs.activity_type = '{activity_type}') as \"{activity_type}\""
+            for activity_type in activity_types)
+        req = f"""
+        with legs as ({self._financial_request(distinct='distinct')}),
+        rates as ({self._market_data_request(day_to=False)})
+        select {period} as transaction_time,
+            {sums}
+        from legs
+        left join rates on rates.transaction_time = legs.transaction_time and rates.quote_currency = legs.quote_currency
+        group by 1
+        order by 1
+        """
+        df = self._read_sql(req, 'get_financial_transaction_pushdown', columns=['transaction_time'] + activity_types,
+                            params={'day_from': str(self.date_from)})
         if df.empty:
             sys.exit("financial dataframe is empty")
 
-        df = (
-            df.merge(self._get_market_data(), how='left', on=['transaction_time', 'quote_currency'])
-            .fillna({'bid_price': 1})
-        )
-        df['usd'] = df['amount'].astype(float) * df['bid_price']
+        df = df.astype({activity_type: float for activity_type in activity_types}).dropna(axis=1, how='all')
         df['transaction_time'] = pd.to_datetime(df['transaction_time'])
+        df = df.fillna(0)
+        df.columns.name = 'activity_type'
+        return df
 
-        if sort_time:
-            df = (df.groupby([pd.Grouper(key='transaction_time', freq=self.freq, closed='left'), 'activity_type'])
-                  .agg({'usd': 'sum'}).reset_index()
-                  .astype({'usd': float})
-                  .pivot_table(index='transaction_time', columns='activity_type', values='usd').reset_index()
-                  .fillna(0)
-                  )
-        else:
-            return df
+    def get_financial_transaction(self, sort_time=True, pushdown=False):
+        """
+        :param sort_time: сводная таблица сумм в USD по периодам self.freq и activity_type
+        :param pushdown: при sort_time=True посчитать сводную таблицу в базе, а не выгружать все операции
+        """
+        if sort_time and pushdown:
+            period = self._sql_period('legs.transaction_time')
+            if period is not None:
+                return self._get_financial_aggregated(period)
+            warnings.warn(f'freq {self.freq} is not supported by pushdown, aggregating in pandas')
+
+        req = self._financial_request() + """
+        ORDER BY activities.created_time desc
+        """
+        df = self._read_sql(req, 'get_financial_transaction').drop_duplicates()
+        if df.empty:
+            sys.exit("financial dataframe is empty")
+
+        market_data = self._get_market_data()
+        with instrumentation.timed('pandas', 'get_financial_transaction'):
+            df = (
+                df.merge(market_data, how='left', on=['transaction_time', 'quote_currency'])
+                .fillna({'bid_price': 1})
+            )
+            df['usd'] = df['amount'].astype(float) * df['bid_price']
+            df['transaction_time'] = pd.to_datetime(df['transaction_time'])
+
+            if sort_time:
+                df = (df.groupby([pd.Grouper(key='transaction_time', freq=self.freq, closed='left'), 'activity_type'])
+                      .agg({'usd': 'sum'}).reset_index()
+                      .astype({'usd': float})
+                      .pivot_table(index='transaction_time', columns='activity_type', values='usd').reset_index()
+                      .fillna(0)
+                      )
         return df
 
 
-    def positions(self):
+    def _positions_from(self, cond: str = ''):
+        # order_legs нужен только как фильтр (позиции, открытые ордерами), поэтому exists вместо join с сортировкой
         req = f"""
-        select principals.name as user_id, accounts.account_code, instruments.symbol as order_symbol, 
-        	positions.quantity, positions.cost, positions.code as position_code, opening_time , instruments.id as symbol, 
-        	instruments.instrument_type
         from dxcore.dxcore.positions as positions
         	join dxcore.dxcore.instruments as instruments on positions.instrument_id = instruments.id
         	join dxcore.dxcore.accounts as accounts on accounts.id = positions.account_id
-        	join dxcore.dxcore.order_legs as order_legs on order_legs.position_code = positions.code
-        	join dxcore.dxcore.orders as orders on orders.id = order_legs.order_id
         	left join dxcore.dxcore.principals as principals on principals.id = accounts.owner_id 
         	where positions.code is not null -- убираем отдельные валюты (т.е. клиенские балансы)
         	and positions.quantity != 0
+        	and exists (select 1 from dxcore.dxcore.order_legs as order_legs where order_legs.position_code = positions.code)
             and {self.user_req_cond}
-        	order by orders.transaction_time desc
+            {cond}
         """
-        with self.engine_dxcore.connect() as conn:
-            positions = (pd.DataFrame(conn.execute(text(req)))
-                         .drop_duplicates()
-                         .astype({'quantity': float,
-                                  'cost': float,
-                                  'quantity': float}
-                                 ))
+        return req
+
+    def _positions_groups(self, cond: str = '', params: dict = None) -> pd.DataFrame:
+        # группировка по юзеру и символу в базе, position_code - массив кодов позиций группы
+        req = f"""
+        select principals.name as user_id, instruments.symbol as order_symbol,
+            sum(positions.quantity) as quantity, sum(positions.cost) as cost,
+            array_agg(distinct positions.code) as position_code
+        {self._positions_from(cond)}
+        group by principals.name, instruments.symbol
+        order by principals.name, instruments.symbol
+        """
+        return self._read_sql(req, 'positions', columns=['user_id', 'order_symbol', 'quantity', 'cost', 'position_code'],
+                              params=params)
+
+    def _finish_positions(self, positions: pd.DataFrame) -> pd.DataFrame:
+        positions = apply_schema(positions, POSITIONS_SCHEMA)
+        positions['open_price'] = positions['cost'] / positions['quantity']
+        positions['date'] = pd.to_datetime(datetime.datetime.now())
+        return positions
+
+    def positions(self):
+        positions = self._positions_groups()
         if positions.empty:
             warnings.warn('no positions')
         else:
-            positions = positions.groupby(['user_id', 'order_symbol']).agg(
-                {'quantity': sum, 'cost': sum, 'position_code': pd.Series.unique}).reset_index()
-            positions['open_price'] = positions['cost'] / positions['quantity']
-            positions['date'] = pd.to_datetime(datetime.datetime.now())
-            return positions
-
-    def _get_user_categories(self):
-        config = configparser.ConfigParser()
-        config.read('/Users/p.matchenkov/Desktop/configurations/config.ini')
-        login = config['AURORA_prod']['login']
-        password = config['AURORA_prod']['password']
+            with instrumentation.timed('pandas', 'positions'):
+                positions = self._finish_positions(positions)
+            return self._track('positions', positions)
+
+    def positions_delta(self):
+        """
+        позиции для периодического опроса: запрашиваются отпечатки групп (юзер, символ), коды позиций
+        догружаются только для новых и изменившихся групп, остальное берется из прошлого снимка этого объекта
+        :return: (снимок как у positions(), изменения с колонкой change: opened, closed, resized, changed)
+            при первом вызове все группы считаются opened
+        """
+        key = ['user_id', 'order_symbol']
+        req = f"""
+        select principals.name as user_id, instruments.symbol as order_symbol,
+            sum(positions.quantity) as quantity, sum(positions.cost) as cost,
+            md5(string_agg(positions.code || ':' || positions.quantity || ':' || positions.cost, ',' order by positions.code))
+                as fingerprint
+        {self._positions_from()}
+        group by principals.name, instruments.symbol
+        """
+        current = self._read_sql(req, 'positions_delta', columns=key + ['quantity', 'cost', 'fingerprint'])
+        current = current.astype({'quantity': float, 'cost': float})
+        previous = getattr(self, '_positions_snapshot', None)
+        if previous is None:
+            previous = pd.DataFrame(columns=key + ['quantity', 'cost', 'fingerprint', 'position_code'])
+
+        merged = current.merge(previous[key + ['quantity', 'cost', 'fingerprint']], on=key, how='outer',
+                               suffixes=('', '_before'), indicator=True)
+        opened = merged['_merge'] == 'left_only'
+        closed = merged['_merge'] == 'right_only'
+        changed = (merged['_merge'] == 'both') & (merged['fingerprint'] != merged['fingerprint_before'])
+        resized = changed & (merged['quantity'] != merged['quantity_before'])
+
+        # коды позиций запрашиваются только для групп, которые появились или изменились
+        refresh = merged.loc[opened | changed, key]
+        codes = pd.DataFrame(columns=key + ['position_code'])
+        if not refresh.empty:
+            codes = self._positions_groups(
+                "and (principals.name, instruments.symbol) in "
+                "(select * from unnest(cast(:group_users as text[]), cast(:group_symbols as text[])))",
+                {'group_users': refresh['user_id'].astype(str).tolist(),
+                 'group_symbols': refresh['order_symbol'].astype(str).tolist()})[key + ['position_code']]
+        unchanged = merged.loc[~(opened | changed | closed), key]
+        position_codes = pd.concat([previous[key + ['position_code']].merge(unchanged, on=key), codes], ignore_index=True)
+
+        snapshot = current.merge(position_codes, on=key, how='left').sort_values(key, ignore_index=True)
+        self._positions_snapshot = snapshot
+        with instrumentation.timed('pandas', 'positions_delta'):
+            positions = self._finish_positions(snapshot.drop(columns=['fingerprint']))
+
+        merged['change'] = None
+        merged.loc[opened, 'change'] = 'opened'
+        merged.loc[closed, 'change'] = 'closed'
+        merged.loc[changed, 'change'] = 'changed'
+        merged.loc[resized, 'change'] = 'resized'
+        deltas = (merged.loc[merged['change'].notna(), key + ['change', 'quantity_before', 'quantity', 'cost_before', 'cost']]
+                  .reset_index(drop=True))
+        return self._track('positions', positions), deltas
+
+    def _get_user_categories(self, ttl: float = 3600):
+        """
+        категории юзера из register api, с meta_cache ответ переиспользуется ttl секунд
+        """
+        import requests
+        from requests.auth import HTTPBasicAuth
+
         if type(self.up) == tuple:
             sys.exit('only one user can be passed (has passed tuple)')
-        else:
-            url = f"https://cexprod.prosp.devexperts.com/dxweb/rest/api/register/client/default/{self.up}"
-            response = json.dumps(requests.get(url, auth=HTTPBasicAuth(login, password)).json())
-            return json.loads(response)
+        if self.meta_cache is not None:
+            cached = self.meta_cache.categories(self.up, ttl)
+            if cached is not None:
+                return cached
 
-    def balance(self):
+        config = read_config()
+        login = config['AURORA_prod']['login']
+        password = config['AURORA_prod']['password']
+        url = f"https://cexprod.prosp.devexperts.com/dxweb/rest/api/register/client/default/{self.up}"
+        categories = requests.get(url, auth=HTTPBasicAuth(login, password),
+                                  hooks={'response': instrumentation.record_response}).json()
+        if self.meta_cache is not None:
+            self.meta_cache.write_categories(self.up, categories)
+        return categories
+
+    def balance(self, price_provider=None):
+        """
+        балансы юзеров в USD
+        :param price_provider: объект с методом prices() -> {символ: цена} из prices.py,
+            по умолчанию последние котировки dxcore с TTL-кэшем
+        """
         req = f"""
         SELECT
             trim(trailing '$' from instruments.symbol) as symbol,
@@ -296,24 +721,18 @@ class TradingPlatform():
         GROUP BY
             accounts.account_code, principals.name, instruments.symbol
             """
-        with self.engine_dxcore.connect() as conn:
-            df = pd.DataFrame(conn.execute(text(req))).astype({'balance': float})
-
-        # get BTC and ETH prices for convert balance to usd
-        ticker = yf.Ticker("BTC-USD")
-        btc = ticker.history(start=f"{datetime.date.today()}").reset_index().iloc[0]['Close']
-        ticker = yf.Ticker("ETH-USD")
-        eth = ticker.history(start=f"{datetime.date.today()}").reset_index().iloc[0]['Close']
-
-        df['usd'] = 0
-        df.loc[df['symbol'] == 'BTC', 'usd'] = df['balance'] * btc
-        df.loc[df['symbol'] == 'ETH', 'usd'] = df['balance'] * eth
-        df.loc[df['symbol'] == 'USDT', 'usd'] = df['balance'] * 1
+        df = self._read_sql(req, 'balance').astype({'balance': float})
+
+        # перевод в USD по словарю символ -> цена, символы без цены дают 0
+        prices = (price_provider or QuotePriceProvider(self)).prices()
+        df['usd'] = df['balance'] * df['symbol'].map(prices).fillna(0)
         df = df.groupby('user_id').agg({'usd': sum})
         return df
 
 
 class KeyClock():
+    kc_url = 'https://auth.prod.broker.internal/auth/admin/realms/general'
+
     def __init__(self, users):
         if isinstance(users, list):
             if len(users) > 1:
@@ -324,11 +743,12 @@ class KeyClock():
             self.ups = [users]
         else:
             sys.exit('Datatype error, should be str or list format')
+        self.session = http_session()
+        self.session.verify = False
 
 
-    def _get_kc_token(self):
-        config = configparser.ConfigParser()
-        config.read('/Users/p.matchenkov/Desktop/configurations/config.ini')
+    def _login_kc(self) -> tuple:
+        config = read_config()
         username = config['KEYCLOAK_prod']['login']
         password = config['KEYCLOAK_prod']['password']
         base_url = config['KEYCLOAK_prod']['client_secret']
@@ -340,32 +760,62 @@ class KeyClock():
             'scope': 'openid',
             'client_secret': base_url
         }
-        req_kc_token = requests.post(f'{base_url}/auth/realms/master/protocol/openid-connect/token',
-                          data=json_data, verify=False)
-        token_kc = json.loads(req_kc_token.text)['access_token']
-        return token_kc
-
-
-    def personal_info(self, token_kc):
-        ups_info = pd.DataFrame()
-        for up in self.ups:
-            try:
-                # request data by api keyclock
-                req_up_info = requests.get(f"https://auth.prod.broker.internal/auth/admin/realms/general/users?username={up}",
-                                            headers={'Authorization': f'bearer {token_kc}'}, verify=False)
-                req_up_info.raise_for_status()
-            except requests.exceptions.RequestException as err:
-                print(req_up_info.status_code)
-                raise SystemExit(err)
-
-        client_for_check = pd.DataFrame(json.loads(req_up_info.text))
-        df = pd.concat([client_for_check.drop(['attributes'], axis=1),
-                        client_for_check['attributes'].apply(pd.Series)], axis=1)
+        req_kc_token = self.session.post(f'{base_url}/auth/realms/master/protocol/openid-connect/token',
+                                         data=json_data)
+        token = json.loads(req_kc_token.text)
+        return token['access_token'], token.get('expires_in')
+
+
+    def _get_kc_token(self):
+        # токен keycloak общий на процесс и запрашивается заново только перед истечением expires_in
+        return token_provider(('keycloak', 'support-api'), self._login_kc).get()
+
+
+    def _get_kc(self, url: str, token_kc: str = None):
+        # на 401 переданный или кэшированный токен сбрасывается и запрос повторяется с новым
+        tokens = token_provider(('keycloak', 'support-api'), self._login_kc)
+        token_kc = token_kc or tokens.get()
+        response = self.session.get(url, headers={'Authorization': f'bearer {token_kc}'}, timeout=30)
+        if response.status_code == 401:
+            tokens.invalidate(token_kc)
+            response = self.session.get(url, headers={'Authorization': f'bearer {tokens.get()}'}, timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+
+    @staticmethod
+    def _users_frame(records: list) -> pd.DataFrame:
+        # attributes раскладываются в колонки одним проходом json_normalize, значения остаются списками
+        users = pd.DataFrame(records).drop(columns=['attributes'], errors='ignore')
+        attributes = pd.json_normalize([record.get('attributes') or {} for record in records], max_level=0)
+        return pd.concat([users, attributes], axis=1)
+
+
+    def personal_info(self, token_kc=None, max_workers: int = 8, page_threshold: int = 200, page_size: int = 1000):
+        """
+        данные keycloak по всем self.ups одним датафреймом
+        :param token_kc: токен keycloak, по умолчанию кэшированный _get_kc_token
+        :param page_threshold: начиная с этого числа юзеров реалм выгружается постранично и фильтруется локально
+        """
+        if len(self.ups) >= page_threshold:
+            records, first = [], 0
+            while True:
+                page = self._get_kc(f"{self.kc_url}/users?first={first}&max={page_size}", token_kc)
+                records += page
+                if len(page) < page_size:
+                    break
+                first += page_size
+            wanted = {up.lower() for up in self.ups}
+            ups_info = self._users_frame([record for record in records if record['username'] in wanted])
+        else:
+            ups_info, errors = fan_out(
+                lambda up: self._users_frame(self._get_kc(f"{self.kc_url}/users?username={up}&exact=true", token_kc)),
+                self.ups, max_workers, key_name='up')
+            if not errors.empty:
+                warnings.warn(f"keycloak data doesnt received for {errors['up'].tolist()}")
+
         # df = df[['username', 'email', 'country', 'phoneNumber']] # исправить, если нет phoneNumber у юзера
         # extract country and number from list type
         # df['country'] = df['country'].apply(lambda x: x[0]) # исправить, если нет phoneNumber у юзера
         # df['phoneNumber'] = df['phoneNumber'].apply(lambda x: x[0]) # исправить, если нет phoneNumber у юзера
-        ups_info = pd.concat([ups_info, df])
         return ups_info
-
-